@@ -40,7 +40,7 @@ print("Leader hub initialized!")
 # Initialize state
 switch_states = {}
 command_number = 0
-processed_statuses = set()
+last_status = {}  # Status channel -> number of the last status processed
 
 def send_switch_command(switch_name, position):
     """Send command to switch"""
@@ -50,22 +50,24 @@ def send_switch_command(switch_name, position):
     print(f"Sending command #{command_number}: {switch_name} -> {position_str}")
     hub.ble.broadcast((command_number, switch_name, position))
 
+STATUS_CHANNELS = (SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3,
+                   SWITCH_STATUS_4, SWITCH_STATUS_5)
+
 def check_status_updates():
     """Check for status updates from all switch hubs"""
-    for channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                   SWITCH_STATUS_4, SWITCH_STATUS_5]:
+    for channel in STATUS_CHANNELS:
         status = hub.ble.observe(channel)
-        if status and status[0] not in processed_statuses:
-            status_number = status[0]
-            
+        # Any number other than the last one seen on the channel is a new status,
+        # also after the hub restarted and counts from 1 again
+        if status and status[0] != last_status.get(channel):
+            last_status[channel] = status[0]
+
             # Process pairs of (switch_letter, position)
             for i in range(1, len(status), 2):
                 switch_letter = status[i]
                 position = status[i+1]
                 switch_name = "SWITCH_" + switch_letter
                 switch_states[switch_name] = position
-            
-            processed_statuses.add(status_number)
 
 def show_status():
     """Display current status of all devices"""
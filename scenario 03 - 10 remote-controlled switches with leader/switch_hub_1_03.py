@@ -29,6 +29,10 @@ MOTOR_POWER = 100  # Power in %
 M_MOVE_TIME = 70   # Time in ms for M motors (DCMotor)
 L_MOVE_TIME = 85   # Time in ms for L motors (Motor)
 
+# Switch positions are kept in the hub's storage, so a restart resumes from them
+POSITIONS_OFFSET = 16
+POSITIONS_MAGIC = 0x5A  # First byte of stored positions
+
 # Initialize constants
 switch_states = {
     "SWITCH_A": SWITCH_POSITION["STRAIGHT"],
@@ -44,9 +48,35 @@ switch_A = DCMotor(Port.A)  # Left switch, M motor
 switch_B = Motor(Port.B)    # Right switch, L motor
 print("Hub and motors initialized!")
 
+def broadcast_status():
+    """Broadcast the positions of all switches on this hub as name-position pairs"""
+    global status_number
+    status_number += 1
+    hub.ble.broadcast((status_number, 
+                      "A", switch_states["SWITCH_A"],
+                      "B", switch_states["SWITCH_B"]))
+    save_positions()
+
+def load_positions():
+    """Resume from the switch positions stored by the last run; returns False if there are none"""
+    data = hub.system.storage(POSITIONS_OFFSET, read=2)
+    if data[0] != POSITIONS_MAGIC:
+        return False
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))  # Bit 0 is switch A
+        switch_states[switch_name] = 1 if data[1] & bit else 0
+    return True
+
+def save_positions():
+    """Keep the switch positions in the hub's storage to resume from them after a restart"""
+    mask = 0
+    for switch_name, position in switch_states.items():
+        if position:
+            mask |= 1 << (ord(switch_name[-1]) - ord("A"))
+    hub.system.storage(POSITIONS_OFFSET, write=bytes([POSITIONS_MAGIC, mask]))
+
 def move_switch(switch_name, position):
     """Move switch and broadcast its new position"""
-    global status_number
     print("Moving {0} to {1} position!".format(
         switch_name,
         "DIVERGING" if position else "STRAIGHT"
@@ -70,10 +100,7 @@ def move_switch(switch_name, position):
 
     # Update state and broadcast status as name-position pairs
     switch_states[switch_name] = position
-    status_number += 1
-    hub.ble.broadcast((status_number, 
-                      "A", switch_states["SWITCH_A"],
-                      "B", switch_states["SWITCH_B"]))
+    broadcast_status()
 
 def check_commands():
     """Check for and handle any incoming commands"""
@@ -94,10 +121,16 @@ def check_commands():
                 oldest = min(processed_commands)
                 processed_commands.remove(oldest)
 
-# Initialize switches to STRAIGHT
-for name in switch_states:
-    print("Initializing {0} to STRAIGHT...".format(name))
-    move_switch(name, SWITCH_POSITION["STRAIGHT"])
+# Resume from the stored switch positions with a single status; without any, set all switches to STRAIGHT
+if load_positions():
+    print("Resumed switch positions: " +
+          ", ".join("{0} {1}".format(name, "DIVERGING" if switch_states[name] else "STRAIGHT")
+                    for name in switch_states))
+    broadcast_status()
+else:
+    for name in switch_states:
+        print("Initializing {0} to STRAIGHT...".format(name))
+        move_switch(name, SWITCH_POSITION["STRAIGHT"])
 
 print("Switches ready! Press button to stop.")
 
@@ -28,6 +28,10 @@ SWITCH_POSITION = {
 MOTOR_POWER = 100    # Power in %
 MOVE_TIME = 60       # Time in ms for M motors (DCMotor)
 
+# Switch positions are kept in the hub's storage, so a restart resumes from them
+POSITIONS_OFFSET = 16
+POSITIONS_MAGIC = 0x5A  # First byte of stored positions
+
 # Initialize constants
 switch_states = {
     "SWITCH_J": SWITCH_POSITION["STRAIGHT"]
@@ -41,9 +45,34 @@ hub = TechnicHub(broadcast_channel=SWITCH_STATUS_5,
 switch_J = DCMotor(Port.A)  # Left switch, M motor
 print("Hub and motor initialized!")
 
+def broadcast_status():
+    """Broadcast the positions of all switches on this hub as name-position pairs"""
+    global status_number
+    status_number += 1
+    hub.ble.broadcast((status_number, 
+                      "J", switch_states["SWITCH_J"]))
+    save_positions()
+
+def load_positions():
+    """Resume from the switch positions stored by the last run; returns False if there are none"""
+    data = hub.system.storage(POSITIONS_OFFSET, read=2)
+    if data[0] != POSITIONS_MAGIC:
+        return False
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))  # Bit 0 is switch A
+        switch_states[switch_name] = 1 if data[1] & bit else 0
+    return True
+
+def save_positions():
+    """Keep the switch positions in the hub's storage to resume from them after a restart"""
+    mask = 0
+    for switch_name, position in switch_states.items():
+        if position:
+            mask |= 1 << (ord(switch_name[-1]) - ord("A"))
+    hub.system.storage(POSITIONS_OFFSET, write=bytes([POSITIONS_MAGIC, mask]))
+
 def move_switch(switch_name, position):
     """Move switch and broadcast its new position"""
-    global status_number
     
     print("Moving {0} to {1} position!".format(
         switch_name,
@@ -62,9 +91,7 @@ def move_switch(switch_name, position):
 
     # Update state and broadcast status as name-position pairs
     switch_states[switch_name] = position
-    status_number += 1
-    hub.ble.broadcast((status_number, 
-                      "J", switch_states["SWITCH_J"]))
+    broadcast_status()
 
 def check_commands():
     """Check for and handle any incoming commands"""
@@ -85,10 +112,16 @@ def check_commands():
                 oldest = min(processed_commands)
                 processed_commands.remove(oldest)
 
-# Initialize switches to STRAIGHT
-for name in switch_states:
-    print("Initializing {0} to STRAIGHT...".format(name))
-    move_switch(name, SWITCH_POSITION["STRAIGHT"])
+# Resume from the stored switch positions with a single status; without any, set all switches to STRAIGHT
+if load_positions():
+    print("Resumed switch positions: " +
+          ", ".join("{0} {1}".format(name, "DIVERGING" if switch_states[name] else "STRAIGHT")
+                    for name in switch_states))
+    broadcast_status()
+else:
+    for name in switch_states:
+        print("Initializing {0} to STRAIGHT...".format(name))
+        move_switch(name, SWITCH_POSITION["STRAIGHT"])
 
 print("Switch ready! Press button to stop.")
 
@@ -70,7 +70,7 @@ print("Leader hub initialized!")
 switch_states = {}
 train_states = {}
 command_number = 0
-processed_statuses = set()
+last_status = {}  # Status channel -> number of the last status processed
 
 def send_switch_command(switch_name, position):
     """Send a command to the specified switch: tell it to switch to specified position"""
@@ -113,53 +113,57 @@ def parse_pattern(pattern_str):
 
     return pattern
 
+def handle_switch_status(channel, status):
+    """Process pairs of (switch_letter, position)"""
+    for i in range(1, len(status), 2):
+        switch_letter = status[i]
+        position = status[i+1]
+        switch_name = "SWITCH_" + switch_letter
+        switch_states[switch_name] = position
+        print(f"Updated {switch_name} to {'DIVERGING' if position else 'STRAIGHT'}")
+
+def handle_train_status(channel, status):
+    """Record the train's color and movement, and the pattern it is seeking"""
+    train_name = status[1]
+    color_code = status[2]
+    movement_code = status[3]
+
+    train_states[train_name] = {
+        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
+        'color': TRAIN_COLOR_FROM_CODE[color_code]
+    }
+
+    # If train is seeking a pattern, save it
+    if len(status) > 4:
+        pattern_length = status[4]
+        pattern = [TRAIN_COLOR_FROM_CODE[code] 
+                 for code in status[5:5+pattern_length]]
+        train_states[train_name]['target_pattern'] = pattern
+
+    print(f"Updated {train_name} status")
+
+# Status channel -> function that processes the statuses broadcast on it
+STATUS_HANDLERS = {
+    SWITCH_STATUS_1: handle_switch_status,
+    SWITCH_STATUS_2: handle_switch_status,
+    SWITCH_STATUS_3: handle_switch_status,
+    SWITCH_STATUS_4: handle_switch_status,
+    SWITCH_STATUS_5: handle_switch_status,
+    TRAIN_STATUS_CSX: handle_train_status,
+}
+STATUS_SOURCES = tuple(STATUS_HANDLERS.items())
+
 def check_status_updates():
     """Check for status updates from all hubs"""
-    for channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                   SWITCH_STATUS_4, SWITCH_STATUS_5, TRAIN_STATUS_CSX]:
+    for channel, handler in STATUS_SOURCES:
         status = hub.ble.observe(channel)
 
-        if status and len(status) >= 2:
-            status_number = status[0]
-            status_id = (channel, status_number)
-
-            if status_id not in processed_statuses:
-                print(f"Processing new status #{status_number} from channel {channel}")
-
-                if channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                             SWITCH_STATUS_4, SWITCH_STATUS_5]:
-                    # Process pairs of (switch_letter, position)
-                    for i in range(1, len(status), 2):
-                        switch_letter = status[i]
-                        position = status[i+1]
-                        switch_name = "SWITCH_" + switch_letter
-                        switch_states[switch_name] = position
-                        print(f"Updated {switch_name} to {'DIVERGING' if position else 'STRAIGHT'}")
-
-                elif channel == TRAIN_STATUS_CSX:
-                    train_name = status[1]
-                    color_code = status[2]
-                    movement_code = status[3]
-
-                    train_states[train_name] = {
-                        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
-                        'color': TRAIN_COLOR_FROM_CODE[color_code]
-                    }
-
-                    # If train is seeking a pattern, save it
-                    if len(status) > 4:
-                        pattern_length = status[4]
-                        pattern = [TRAIN_COLOR_FROM_CODE[code] 
-                                 for code in status[5:5+pattern_length]]
-                        train_states[train_name]['target_pattern'] = pattern
-
-                    print(f"Updated {train_name} status")
-
-                processed_statuses.add(status_id)
-
-            # Clean up old statuses if we have too many
-            if len(processed_statuses) > 100:
-                processed_statuses.clear()
+        # Any number other than the last one seen on the channel is a new status,
+        # also after the hub restarted and counts from 1 again
+        if status and len(status) >= 2 and status[0] != last_status.get(channel):
+            last_status[channel] = status[0]
+            print(f"Processing new status #{status[0]} from channel {channel}")
+            handler(channel, status)
 
 def show_status():
     """Display current train status"""
@@ -10,7 +10,8 @@
 
 from pybricks.hubs import InventorHub
 from pybricks.parameters import Port, Color
-from pybricks.tools import wait
+from pybricks.tools import wait, StopWatch
+from micropython import const
 
 # Broadcast channels
 COMMAND_CHANNEL = 1     # Leader -> Switch/train hubs
@@ -27,6 +28,10 @@ SWITCH_POSITION = {
     "DIVERGING": 1
 }
 
+# The leader sets switches declaratively: it broadcasts (cmd_num, "DESIRED", version, known, positions)
+# with one bit per switch A-J in the masks. Switch hubs move their switches to match
+# and add ("V", version) to their status once they have.
+
 # Train commands
 TRAIN_COMMAND = {
     "STOP": 0,
@@ -62,6 +67,41 @@ VALID_PATTERN_COLORS = {
     "BLUE": Color.BLUE
 }
 
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which the 'log' command prints, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(32)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
+
 # Clear terminal output
 print("\x1b[H\x1b[2J", end="")
 
@@ -76,15 +116,44 @@ print("Leader hub initialized!")
 switch_states = {}
 train_states = {}
 command_number = 0
-processed_statuses = set()
-
-def send_switch_command(switch_name, position):
-    """Send a command to the specified switch: tell it to switch to specified position"""
-    global command_number
-    command_number += 1
-    position_str = 'DIVERGING' if position else 'STRAIGHT'
-    print(f"Sending command #{command_number}: {switch_name} -> {position_str}")
-    hub.ble.broadcast((command_number, switch_name, position))
+last_status = {}        # Status channel -> number of the last status processed
+desired_switches = {}   # Switch -> position the switch hubs should converge to
+desired_version = 0     # Bumped whenever desired_switches changes
+desired_message = None  # desired_switches as a DESIRED message
+switch_versions = {}    # Switch -> desired version its hub reported last
+switch_move_times = {}  # Switch status channel -> ms the hub's last move took
+
+def set_desired(settings):
+    """
+    Change the desired positions of some switches and put the whole vector of desired
+    positions on air. It stays there until the next train command, and the switch hubs
+    keep converging to it while it does.
+    Returns the version that confirms the new positions.
+    """
+    global desired_version, desired_message, command_number
+    changed = [(switch, position) for switch, position in settings
+               if desired_switches.get(switch) != position]
+    if changed:
+        for switch, position in changed:
+            desired_switches[switch] = position
+        desired_version += 1
+        command_number += 1
+
+        # One bit per switch, bit 0 is switch A
+        known = 0
+        positions = 0
+        for switch, position in desired_switches.items():
+            bit = 1 << (ord(switch[-1]) - ord("A"))
+            known |= bit
+            if position:
+                positions |= bit
+        desired_message = (command_number, "DESIRED", desired_version, known, positions)
+        log(LOG_INFO, f"Desired switches v{desired_version}: " +
+                      ", ".join(f"{name} -> {'DIVERGING' if pos else 'STRAIGHT'}" for name, pos in changed))
+
+    if desired_message:
+        hub.ble.broadcast(desired_message)
+    return desired_version
 
 def send_train_command(train_name, command_type, pattern=None):
     """Send command to train: forward/backward until color pattern or stop"""
@@ -100,7 +169,7 @@ def send_train_command(train_name, command_type, pattern=None):
         command = (command_number, train_name, command_type)
 
     pattern_str = f", pattern={pattern}" if pattern else ""
-    print(f"Sending command #{command_number}: {train_name} -> {command_type}{pattern_str}")
+    log(LOG_INFO, f"Sending command #{command_number}: {train_name} -> {command_type}{pattern_str}")
     hub.ble.broadcast(command)
 
 def parse_pattern(pattern_str):
@@ -118,53 +187,72 @@ def parse_pattern(pattern_str):
 
     return pattern
 
+def handle_switch_status(channel, status):
+    """Process pairs of (switch_letter, position), then ("V", applied version) and ("T", move time in ms)"""
+    names = []
+    for i in range(1, len(status) - 1, 2):
+        key = status[i]
+        value = status[i+1]
+        if key == "V":
+            for switch_name in names:
+                switch_versions[switch_name] = value
+            continue
+        if key == "T":
+            switch_move_times[channel] = value
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Switch hub on channel {channel} took {value} ms")
+            continue
+        switch_name = "SWITCH_" + key
+        switch_states[switch_name] = value
+        names.append(switch_name)
+        if LOG_HOT_PATHS:
+            log(LOG_DEBUG, f"Updated {switch_name} to {'DIVERGING' if value else 'STRAIGHT'}")
+
+def handle_train_status(channel, status):
+    """Record a train's color and movement"""
+    train_name = status[1]
+    color_code = status[2]
+    movement_code = status[3]
+
+    train_states[train_name] = {
+        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
+        'color': TRAIN_COLOR_FROM_CODE[color_code]
+    }
+
+    # If train is seeking a pattern, save it
+    if len(status) > 4:
+        pattern_length = status[4]
+        pattern = [TRAIN_COLOR_FROM_CODE[code] 
+                 for code in status[5:5+pattern_length]]
+        train_states[train_name]['target_pattern'] = pattern
+
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, f"Updated {train_name} status: {train_states[train_name]['movement']}")
+
+# Status channel -> function that processes the statuses broadcast on it
+STATUS_HANDLERS = {
+    SWITCH_STATUS_1: handle_switch_status,
+    SWITCH_STATUS_2: handle_switch_status,
+    SWITCH_STATUS_3: handle_switch_status,
+    SWITCH_STATUS_4: handle_switch_status,
+    SWITCH_STATUS_5: handle_switch_status,
+    TRAIN_STATUS_CSX: handle_train_status,
+}
+STATUS_SOURCES = tuple(STATUS_HANDLERS.items())  # Built once so polling allocates nothing
+
 def check_status_updates():
     """Check for status updates from all hubs"""
-    for channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                   SWITCH_STATUS_4, SWITCH_STATUS_5, TRAIN_STATUS_CSX]:
+    for channel, handler in STATUS_SOURCES:
         status = hub.ble.observe(channel)
 
-        if status and len(status) >= 2:
-            status_number = status[0]
-            status_id = (channel, status_number)
-
-            if status_id not in processed_statuses:
-                print(f"Processing new status #{status_number} from channel {channel}")
-
-                if channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                             SWITCH_STATUS_4, SWITCH_STATUS_5]:
-                    # Process pairs of (switch_letter, position)
-                    for i in range(1, len(status), 2):
-                        switch_letter = status[i]
-                        position = status[i+1]
-                        switch_name = "SWITCH_" + switch_letter
-                        switch_states[switch_name] = position
-                        print(f"Updated {switch_name} to {'DIVERGING' if position else 'STRAIGHT'}")
-
-                elif channel == TRAIN_STATUS_CSX:
-                    train_name = status[1]
-                    color_code = status[2]
-                    movement_code = status[3]
-
-                    train_states[train_name] = {
-                        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
-                        'color': TRAIN_COLOR_FROM_CODE[color_code]
-                    }
-
-                    # If train is seeking a pattern, save it
-                    if len(status) > 4:
-                        pattern_length = status[4]
-                        pattern = [TRAIN_COLOR_FROM_CODE[code] 
-                                 for code in status[5:5+pattern_length]]
-                        train_states[train_name]['target_pattern'] = pattern
-
-                    print(f"Updated {train_name} status")
-
-                processed_statuses.add(status_id)
-
-            # Clean up old statuses if we have too many
-            if len(processed_statuses) > 100:
-                processed_statuses.clear()
+        # Each hub counts its statuses up, so any number other than the last one
+        # seen on the channel is new. This also covers a counter that wrapped or
+        # a hub that restarted and counts from 1 again.
+        if status and len(status) >= 2 and status[0] != last_status.get(channel):
+            last_status[channel] = status[0]
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Processing new status #{status[0]} from channel {channel}")
+            handler(channel, status)
 
 def show_status():
     """Display current status of all devices"""
@@ -184,6 +272,8 @@ def show_status():
                 switch_name,
                 "DIVERGING" if position == SWITCH_POSITION["DIVERGING"] else "STRAIGHT"
             ))
+        for channel in sorted(switch_move_times):
+            print(f"Hub {channel - SWITCH_STATUS_1 + 1} last move took {switch_move_times[channel]} ms")
 
     print("\nCurrent train position:")
     if not train_states:
@@ -397,17 +487,30 @@ def path_to_commands(path, initial_facing):
     commands = []
     current_facing = initial_facing
 
-    # First set all switches to STRAIGHT for safety
-    all_switches = set()
-    for edge in track.values():
-        all_switches.update(edge["switches"].keys())
+    # Switch positions as they will be when each command runs, starting from the
+    # positions the switch hubs have confirmed. Commands for switches that are already
+    # in place are left out.
+    expected = switch_states.copy()
 
-    for switch in all_switches:
-        commands.append({
-            'type': 'switch',
-            'switch': switch,
-            'position': SWITCH_POSITION["STRAIGHT"]
-        })
+    def set_switch(switch, position):
+        if expected.get(switch) != position:
+            commands.append({
+                'type': 'switch',
+                'switch': switch,
+                'position': position
+            })
+            expected[switch] = position
+
+    # First set the switches the route doesn't use to STRAIGHT for safety;
+    # the route sets its own switches below
+    route_switches = set()
+    for edge in path:
+        route_switches.update(track[edge]["switches"].keys())
+
+    for edge in track.values():
+        for switch in edge["switches"]:
+            if switch not in route_switches:
+                set_switch(switch, SWITCH_POSITION["STRAIGHT"])
 
     # Convert each path segment into appropriate commands
     for i, (src, dst) in enumerate(path):
@@ -415,11 +518,7 @@ def path_to_commands(path, initial_facing):
         
         # 1. Set required switches for this segment
         for switch, position in segment["switches"].items():
-            commands.append({
-                'type': 'switch',
-                'switch': switch,
-                'position': position
-            })
+            set_switch(switch, position)
 
         # 2. Determine if we need to reverse from previous segment
         must_reverse = False
@@ -446,55 +545,51 @@ def path_to_commands(path, initial_facing):
 
     return commands
 
-def wait_for_switch_update(switch_name, target_position, command_number, timeout=5000):
-    """Wait for switch status update confirming the switch reached desired position"""
-    print(f"Waiting for {switch_name} to reach {'DIVERGING' if target_position else 'STRAIGHT'} position...")
+def switches_confirmed(targets, version):
+    """True once the switch hubs report every (switch, position) in targets, having applied version"""
+    for switch, position in targets:
+        if switch_states.get(switch) != position or switch_versions.get(switch, 0) < version:
+            return False
+    return True
 
-    # Record current number of statuses we've processed
-    initial_status_count = len(processed_statuses)
+def wait_for_switches(targets, version, timeout=10000):
+    """Wait for status updates confirming every (switch, position) in targets"""
+    names = ", ".join(switch_name for switch_name, _ in targets)
+    log(LOG_DEBUG, f"Waiting for {names} to reach their positions...")
 
     interval = 100  # Check every 100ms
     elapsed = 0
 
     while elapsed < timeout:
         check_status_updates()
-
-        # Check if we've received any new status updates since sending command
-        if len(processed_statuses) > initial_status_count:
-            if (switch_name in switch_states and
-                switch_states[switch_name] == target_position):
-                print(f"{switch_name} reached desired position!")
-                return True
+        if switches_confirmed(targets, version):
+            log(LOG_DEBUG, f"{names} reached desired positions!")
+            return True
 
         wait(interval)
         elapsed += interval
 
-    print(f"Warning: Timed out waiting for {switch_name} status update!")
+    log(LOG_WARN, f"Timed out waiting for {names} status update!")
     return False
 
-def execute_switch_command(switch_name, position, max_retries=3):
-    """Send switch command and verify it worked, with retries if needed"""
-    global command_number
-
-    for attempt in range(max_retries):
-        if attempt > 0:
-            print(f"Retry attempt {attempt}/{max_retries-1}...")
-
-        # Send command
-        send_switch_command(switch_name, position)
-        command_num = command_number  # Save command number for verification
-        wait(500)
-
-        # Wait for status update from this specific command
-        if wait_for_switch_update(switch_name, position, command_num):
-            return True
-
-        # If we reach here, the switch didn't report success
-        if attempt < max_retries - 1:  # If we have retries left
-            print(f"Switch {switch_name} didn't reach position, retrying...")
-            wait(1000)  # Wait before retry
+def execute_switch_settings(settings):
+    """
+    Set several switches through the desired positions and wait until their hubs confirm them.
+    The hubs move their switches in parallel, and lost messages heal while the desired
+    positions stay on air, so there is nothing to retry.
+    Returns the switches that didn't confirm their position.
+    """
+    version = set_desired(settings)
+    if wait_for_switches(settings, version):
+        return []
+    return [name for name, pos in settings if not switches_confirmed([(name, pos)], version)]
 
-    return False
+def send_calibrate():
+    """Ask the switch hubs to calibrate their L motor switches (B, E, G, I); they store the results"""
+    global command_number
+    command_number += 1
+    log(LOG_INFO, f"Sending command #{command_number}: CALIBRATE")
+    hub.ble.broadcast((command_number, "CALIBRATE"))
 
 def execute_path(train_name, start, end, initial_facing="FORWARD"):
     """
@@ -515,7 +610,7 @@ def execute_path(train_name, start, end, initial_facing="FORWARD"):
 
     # Then generate and display the plan
     print("\nPlanned route:")
-    print("Initial move: Set all switches to STRAIGHT for safety")
+    print("Initial move: Set switches off the route to STRAIGHT for safety")
     print(f"Train starts facing: {initial_facing}")
 
     current_facing = initial_facing
@@ -555,27 +650,38 @@ def execute_path(train_name, start, end, initial_facing="FORWARD"):
     if input("\nExecute route? (y/n): ").lower() != 'y':
         return
 
+    # Refresh the confirmed switch positions so only switches that need to move are sent
+    check_status_updates()
     commands = path_to_commands(path, current_facing)
 
-    for i, cmd in enumerate(commands):
-        print("\nExecuting command {0}/{1}...".format(i + 1, len(commands)))
+    i = 0
+    while i < len(commands):
+        cmd = commands[i]
+        i += 1
+        log(LOG_INFO, "Executing command {0}/{1}...".format(i, len(commands)))
 
         if cmd['type'] == 'switch':
-            if not execute_switch_command(cmd['switch'], cmd['position']):
-                print(f"Failed to set {cmd['switch']} after all retries!")
+            # Set this and the following switch commands together
+            settings = [(cmd['switch'], cmd['position'])]
+            while i < len(commands) and commands[i]['type'] == 'switch':
+                settings.append((commands[i]['switch'], commands[i]['position']))
+                i += 1
+            failed = execute_switch_settings(settings)
+            if failed:
+                log(LOG_ERROR, f"{', '.join(failed)} didn't reach the desired positions!")
                 if input("Continue anyway? (y/n): ").lower() != 'y':
                     return
 
         elif cmd['type'] == 'train':
             pattern = cmd['pattern']
-            print("Looking for pattern: {0}".format(
+            log(LOG_DEBUG, "Looking for pattern: {0}".format(
                 "-".join(str(c).split('.')[-1] for c in pattern)
             ))
 
             send_train_command(train_name, TRAIN_COMMAND[cmd['action']], pattern)
 
             # Wait for movement to complete
-            print("Waiting for train to complete movement...")
+            log(LOG_DEBUG, "Waiting for train to complete movement...")
             wait(1000)  # Initial wait to let train start moving
 
             timeout = 30000  # 30 second timeout
@@ -587,7 +693,7 @@ def execute_path(train_name, start, end, initial_facing="FORWARD"):
                 check_status_updates()
                 if (train_name in train_states and 
                     train_states[train_name]["movement"] == "STOPPED"):
-                    print("Movement completed!")
+                    log(LOG_INFO, "Movement completed!")
                     wait(1000)  # Extra wait to ensure train is fully stopped
                     movement_complete = True
                     break
@@ -595,7 +701,7 @@ def execute_path(train_name, start, end, initial_facing="FORWARD"):
                 elapsed += interval
             
             if not movement_complete:
-                print("Warning: Movement timed out after 30 seconds!")
+                log(LOG_WARN, "Movement timed out after 30 seconds!")
                 if input("Continue anyway? (y/n): ").lower() != 'y':
                     return
 
@@ -609,12 +715,14 @@ print("Switches:")
 print("  s a 0 - Set LA switch (A) to straight")
 print("  s a 1 - Set LA switch (A) to diverging")
 print("  (same for switches B-J)")
+print("  cal   - Calibrate the L motor switches (B, E, G, I)")
 print("Train:")
 print("  t csx f red-yellow   - Move CSX train forward until RED-YELLOW pattern")
 print("  t csx b yellow-green - Move CSX train backward until YELLOW-GREEN pattern")
 print("  t csx s              - Stop CSX train")
 print("Status:")
 print("  st                   - Show all device status")
+print("  log                  - Show recent log messages, including debug")
 print("  q                    - Quit")
 
 while True:
@@ -625,12 +733,16 @@ while True:
         break
     elif cmd in ['st', 'status']:
         show_status()
+    elif cmd == 'log':
+        dump_log()
+    elif cmd == 'cal':
+        send_calibrate()
     elif cmd.startswith('s ') and len(cmd) == 5:
         # Switch commands: s a 0
         switch = f"SWITCH_{cmd[2].upper()}"
         position = int(cmd[4])
         if position in [0, 1]:
-            send_switch_command(switch, position)
+            set_desired([(switch, position)])
         else:
             print("Invalid switch position")
     elif cmd.startswith('t '):
@@ -13,7 +13,9 @@
 from pybricks.hubs import TechnicHub
 from pybricks.pupdevices import DCMotor, Motor  # DCMotor for M, Motor for L
 from pybricks.parameters import Port
-from pybricks.tools import wait
+from pybricks.tools import wait, StopWatch
+from micropython import const
+from ustruct import pack, unpack
 
 # Broadcast channels
 COMMAND_CHANNEL = 1   # Leader -> All switch hubs
@@ -28,7 +30,25 @@ SWITCH_POSITION = {
 # Motor constants
 MOTOR_POWER = 100  # Power in %
 M_MOVE_TIME = 80   # Time in ms for M motors (DCMotor)
-L_MOVE_TIME = 100   # Time in ms for L motors (Motor)
+L_SPEED = 1000      # Speed in deg/s for L motors (Motor), which are stopped by their encoder
+L_MOVE_LIMIT = 400  # Longest time in ms an L motor runs if it doesn't stall
+L_STALL_SPEED = 50  # An L motor below this speed in deg/s...
+L_STALL_TIME = 30   # ...for this many ms has reached the end stop
+L_MIN_THROW = 20    # Degrees from the STRAIGHT end stop above which an L motor switch is DIVERGING
+L_ANGLE_MARGIN = 5  # Degrees short of the calibrated end of a throw where a calibrated L motor stops
+L_TIME_MARGIN = 50  # ms a calibrated L motor may take beyond its calibrated throw time
+
+# Switch positions are kept in the hub's storage, so a restart resumes from them
+POSITIONS_OFFSET = 16
+POSITIONS_MAGIC = 0x5A  # First byte of stored positions
+
+# Calibration of the L motor switches ('cal' on the leader), kept in the hub's storage
+L_SWITCHES = ("SWITCH_E", "SWITCH_G")  # Order of the switches in storage
+CALIBRATION_OFFSET = 0
+CALIBRATION_MAGIC = 0xCA  # First byte of stored calibration
+CALIBRATION_DUTIES = (100, 80, 60, 50, 40)  # Duties in % to try, strongest first
+CALIBRATION_RUNS = 3      # Throws each way that have to succeed at a duty
+CALIBRATION_SLOWDOWN = 120  # % of the full-power throw time a gentler duty may take
 
 # Initialize constants
 switch_states = {
@@ -38,6 +58,45 @@ switch_states = {
 }
 processed_commands = set()
 status_number = 0
+applied_version = 0  # Version of the leader's desired positions this hub has converged to
+last_move_time = 0   # How long the last move of this hub's switches took in ms
+zeroed = set()       # L motor switches whose encoder has angle 0 at the STRAIGHT end stop
+calibration = {}     # L motor switch -> (travel in degrees, duty in %, throw time in ms)
+
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which is printed when the button stops the program, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(16)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
 
 # Initialize hub and motors
 hub = TechnicHub(broadcast_channel=SWITCH_STATUS_3, 
@@ -45,19 +104,46 @@ hub = TechnicHub(broadcast_channel=SWITCH_STATUS_3,
 switch_E = Motor(Port.A)   # Left switch but flipped, L motor
 switch_F = DCMotor(Port.B) # Right switch, M motor
 switch_G = Motor(Port.C)   # Right switch but flipped, L motor
+switch_E.control.stall_tolerances(L_STALL_SPEED, L_STALL_TIME)
+switch_G.control.stall_tolerances(L_STALL_SPEED, L_STALL_TIME)
 print("Hub and motors initialized!")
 
-def move_switch(switch_name, position):
+def broadcast_status():
+    """Broadcast name-position pairs for the switches on this hub, then the applied version and last move time"""
     global status_number
-    print("Moving {0} to {1} position!".format(
-        switch_name,
-        "DIVERGING" if position else "STRAIGHT"
-    ))
-    
+    status_number += 1
+    hub.ble.broadcast((status_number,
+                      "E", switch_states["SWITCH_E"],
+                      "F", switch_states["SWITCH_F"],
+                      "G", switch_states["SWITCH_G"],
+                      "V", applied_version,
+                      "T", last_move_time))
+    save_positions()
+
+def load_positions():
+    """Resume from the switch positions stored by the last run; returns False if there are none"""
+    data = hub.system.storage(POSITIONS_OFFSET, read=2)
+    if data[0] != POSITIONS_MAGIC:
+        return False
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))  # Bit 0 is switch A
+        switch_states[switch_name] = 1 if data[1] & bit else 0
+    return True
+
+def save_positions():
+    """Keep the switch positions in the hub's storage to resume from them after a restart"""
+    mask = 0
+    for switch_name, position in switch_states.items():
+        if position:
+            mask |= 1 << (ord(switch_name[-1]) - ord("A"))
+    hub.system.storage(POSITIONS_OFFSET, write=bytes([POSITIONS_MAGIC, mask]))
+
+def switch_motor(switch_name):
+    """The motor of a switch, its power towards DIVERGING and how long it runs (None for L motors)"""
     if switch_name == "SWITCH_E":
         motor = switch_E
         power = -MOTOR_POWER  # Left switch but flipped
-        move_time = L_MOVE_TIME  # L motor
+        move_time = None  # L motor, stopped by its encoder
     elif switch_name == "SWITCH_F":
         motor = switch_F
         power = -MOTOR_POWER  # Right switch
@@ -65,21 +151,215 @@ def move_switch(switch_name, position):
     else:  # SWITCH_G
         motor = switch_G
         power = MOTOR_POWER  # Right switch but flipped
-        move_time = L_MOVE_TIME  # L motor
+        move_time = None  # L motor, stopped by its encoder
+    return motor, power, move_time
 
-    if position == SWITCH_POSITION["DIVERGING"]:
+def start_switch(switch_name, position):
+    """Start moving a switch; returns its motor and how long it has to run (None for L motors)"""
+    log(LOG_INFO, "Moving {0} to {1} position!".format(
+        switch_name,
+        "DIVERGING" if position else "STRAIGHT"
+    ))
+
+    motor, power, move_time = switch_motor(switch_name)
+    calibrated = switch_name in calibration and switch_name in zeroed
+    if move_time is None and calibrated:  # The lowest duty that reliably throws it
+        duty = calibration[switch_name][1] if power > 0 else -calibration[switch_name][1]
+        motor.dc(duty if position == SWITCH_POSITION["DIVERGING"] else -duty)
+    elif move_time is None:  # Run by speed so the encoder can tell when the throw is done
+        speed = L_SPEED if power > 0 else -L_SPEED
+        motor.run(speed if position == SWITCH_POSITION["DIVERGING"] else -speed)
+    elif position == SWITCH_POSITION["DIVERGING"]:
         motor.dc(power)
-    else:
+    else:  # STRAIGHT
         motor.dc(-power)
-    wait(move_time)
+    return motor, move_time
+
+def throw_done(switch_name, motor, position, elapsed):
+    """
+    True once an L motor has run its throw: calibrated ones when the encoder reaches the
+    calibrated end of the throw, others when they stall at the end stop. Either one stops
+    when it runs too long.
+    """
+    if switch_name not in calibration or switch_name not in zeroed:
+        return motor.stalled() or elapsed >= L_MOVE_LIMIT
+
+    travel, duty, throw_time = calibration[switch_name]
+    if elapsed >= throw_time + L_TIME_MARGIN:
+        return True
+    if position == SWITCH_POSITION["DIVERGING"]:
+        return abs(motor.angle()) >= travel - L_ANGLE_MARGIN
+    return abs(motor.angle()) <= L_ANGLE_MARGIN
+
+def verified_position(switch_name, motor, position):
+    """
+    Where an L motor switch ended up according to its encoder. Until the switch has run
+    into its STRAIGHT end stop once, which then becomes angle 0, it is where it was sent.
+    """
+    if switch_name not in zeroed:
+        if position == SWITCH_POSITION["STRAIGHT"]:
+            motor.reset_angle(0)
+            zeroed.add(switch_name)
+        return position
+    if abs(motor.angle()) >= L_MIN_THROW:
+        return SWITCH_POSITION["DIVERGING"]
+    return SWITCH_POSITION["STRAIGHT"]
+
+def move_switches(targets):
+    """
+    Move several switches at the same time and broadcast the new positions: start all
+    motors, then brake each one when it is done, so this takes as long as the slowest
+    switch instead of the sum of all of them. M motors are done when their move time is
+    up, L motors when their encoder says so, and report the position the encoder found.
+    """
+    global last_move_time
+    timer = StopWatch()
+    running = []
+    for switch_name, position in targets:
+        motor, move_time = start_switch(switch_name, position)
+        running.append((switch_name, position, motor, move_time))
+    while running:
+        elapsed = timer.time()
+        for move in list(running):
+            switch_name, position, motor, move_time = move
+            if move_time is None and throw_done(switch_name, motor, position, elapsed):
+                motor.brake()
+                switch_states[switch_name] = verified_position(switch_name, motor, position)
+                if switch_states[switch_name] != position:
+                    log(LOG_WARN, f"{switch_name} stopped short of its position")
+            elif move_time is not None and elapsed >= move_time:
+                motor.brake()
+                switch_states[switch_name] = position  # M motors have no feedback
+            else:
+                continue
+            running.remove(move)
+        wait(1)
+
+    # Broadcast status as name-position pairs
+    last_move_time = timer.time()
+    broadcast_status()
+
+def measure_throw(motor, duty):
+    """Run an L motor at duty until it stops moving; returns how far from 0 it got and when it stopped"""
+    timer = StopWatch()
+    motor.dc(duty)
+    moved_angle = motor.angle()
+    moved_at = 0
+    started = False
+    while timer.time() < L_MOVE_LIMIT:
+        wait(1)
+        angle = motor.angle()
+        if abs(angle - moved_angle) >= 2:
+            moved_angle = angle
+            moved_at = timer.time()
+            started = True
+        elif started and timer.time() - moved_at >= L_STALL_TIME:
+            break
     motor.brake()
+    return abs(motor.angle()), moved_at
 
-    switch_states[switch_name] = position
-    status_number += 1
-    hub.ble.broadcast((status_number,
-                      "E", switch_states["SWITCH_E"],
-                      "F", switch_states["SWITCH_F"],
-                      "G", switch_states["SWITCH_G"]))
+def calibrate_switch(switch_name):
+    """
+    Find the lowest duty that reliably throws an L motor switch both ways without slowing
+    it down much, with the travel and throw time at that duty. The switch starts and ends
+    against its STRAIGHT end stop.
+    Returns (travel, duty, throw time), or None if it doesn't throw even at full power.
+    """
+    motor, power, _ = switch_motor(switch_name)
+    sign = 1 if power > 0 else -1
+    measure_throw(motor, -sign * MOTOR_POWER)
+    motor.reset_angle(0)
+
+    full_travel = None
+    result = None
+    for duty in CALIBRATION_DUTIES:
+        throws = []
+        for run in range(CALIBRATION_RUNS):
+            travel, diverging_time = measure_throw(motor, sign * duty)
+            back, straight_time = measure_throw(motor, -sign * duty)
+            throws.append((travel, back, max(diverging_time, straight_time)))
+
+        # The throws at full power tell how far a complete throw goes and how fast it can be
+        throw_time = max(time for _, _, time in throws)
+        if full_travel is None:
+            full_travel = max(travel for travel, _, _ in throws)
+            full_time = throw_time
+            if full_travel < L_MIN_THROW:
+                break
+        if any(travel < full_travel - L_ANGLE_MARGIN or back > L_ANGLE_MARGIN
+               for travel, back, _ in throws):
+            break
+        if throw_time * 100 > full_time * CALIBRATION_SLOWDOWN:
+            break
+        result = (min(travel for travel, _, _ in throws), duty, throw_time)
+        log(LOG_INFO, f"{switch_name}: {duty}% throws {result[0]} degrees in {result[2]} ms")
+
+    # Whatever the last throw did, end against the STRAIGHT end stop
+    measure_throw(motor, -sign * MOTOR_POWER)
+    motor.reset_angle(0)
+    return result
+
+def save_calibration():
+    """Keep the calibration in the hub's storage so it survives a restart"""
+    data = bytes([CALIBRATION_MAGIC])
+    for switch_name in L_SWITCHES:
+        travel, duty, throw_time = calibration.get(switch_name, (0, 0, 0))
+        data += pack("<HBH", travel, duty, throw_time)
+    hub.system.storage(CALIBRATION_OFFSET, write=data)
+
+def load_calibration():
+    """Read the calibration stored by an earlier run, if there is one"""
+    data = hub.system.storage(CALIBRATION_OFFSET, read=1 + 5 * len(L_SWITCHES))
+    if data[0] != CALIBRATION_MAGIC:
+        log(LOG_INFO, "No calibration stored, L motors run into their end stops")
+        return
+    for i, switch_name in enumerate(L_SWITCHES):
+        travel, duty, throw_time = unpack("<HBH", data[1 + 5 * i:6 + 5 * i])
+        if duty:
+            calibration[switch_name] = (travel, duty, throw_time)
+            log(LOG_INFO, f"{switch_name}: calibrated to {duty}%, {travel} degrees in {throw_time} ms")
+
+def calibrate():
+    """Calibrate the L motor switches of this hub, store the results and put the switches back"""
+    before = dict(switch_states)
+    for switch_name in L_SWITCHES:
+        log(LOG_INFO, f"Calibrating {switch_name}...")
+        result = calibrate_switch(switch_name)
+        if result:
+            calibration[switch_name] = result
+        else:
+            calibration.pop(switch_name, None)
+            log(LOG_WARN, f"{switch_name} didn't throw, leaving it uncalibrated")
+        zeroed.add(switch_name)
+        switch_states[switch_name] = SWITCH_POSITION["STRAIGHT"]
+    save_calibration()
+
+    targets = [(name, before[name]) for name in L_SWITCHES if before[name] != switch_states[name]]
+    if targets:
+        move_switches(targets)
+    else:
+        broadcast_status()
+
+def reconcile(version, known, positions):
+    """
+    Converge this hub's switches to the leader's desired positions, given as bitmasks
+    (bit 0 is switch A): known has the switches the leader cares about, positions has
+    the diverging ones. Reports the version once the switches are there.
+    """
+    global applied_version
+    targets = []
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))
+        position = 1 if positions & bit else 0
+        if known & bit and switch_states[switch_name] != position:
+            targets.append((switch_name, position))
+
+    if targets:
+        applied_version = version
+        move_switches(targets)
+    elif version != applied_version:
+        applied_version = version
+        broadcast_status()
 
 def check_commands():
     """Check for and handle any incoming commands"""
@@ -88,28 +368,37 @@ def check_commands():
         command_number = cmd[0]
         switch_name = cmd[1]
         
-        if (switch_name in ["SWITCH_E", "SWITCH_F", "SWITCH_G"] and 
-            command_number not in processed_commands and 
-            len(cmd) == 3):
-            
-            position = cmd[2]
-            move_switch(switch_name, position)
+        if switch_name == "DESIRED" and len(cmd) == 5:
+            # The leader keeps its desired positions of all switches on air, so this
+            # is checked every time and also heals commands that were missed
+            reconcile(cmd[2], cmd[3], cmd[4])
+
+        elif switch_name == "CALIBRATE" and command_number not in processed_commands:
+            calibrate()
             processed_commands.add(command_number)
-            
-            if len(processed_commands) > 100:
-                oldest = min(processed_commands)
-                processed_commands.remove(oldest)
 
-# Initialize switches to STRAIGHT
-for name in switch_states:
-    print("Initializing {0} to STRAIGHT...".format(name))
-    move_switch(name, SWITCH_POSITION["STRAIGHT"])
+        if len(processed_commands) > 100:
+            oldest = min(processed_commands)
+            processed_commands.remove(oldest)
+
+load_calibration()
+
+# Resume from the stored switch positions with a single status; without any, set all switches to STRAIGHT
+if load_positions():
+    print("Resumed switch positions: " +
+          ", ".join("{0} {1}".format(name, "DIVERGING" if switch_states[name] else "STRAIGHT")
+                    for name in switch_states))
+    broadcast_status()
+else:
+    print("Initializing switches to STRAIGHT...")
+    move_switches([(name, SWITCH_POSITION["STRAIGHT"]) for name in switch_states])
 
 print("Switches ready! Press button to stop.")
 
 while True:
     if hub.buttons.pressed():
         print("Detected button press: stopped.")
+        dump_log()
         break
         
     check_commands()
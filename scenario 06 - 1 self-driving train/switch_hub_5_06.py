@@ -13,7 +13,8 @@
 from pybricks.hubs import TechnicHub
 from pybricks.pupdevices import DCMotor
 from pybricks.parameters import Port
-from pybricks.tools import wait
+from pybricks.tools import wait, StopWatch
+from micropython import const
 
 # Broadcast channels
 COMMAND_CHANNEL = 1   # Leader -> All switch hubs
@@ -29,12 +30,52 @@ SWITCH_POSITION = {
 MOTOR_POWER = 100    # Power in %
 MOVE_TIME = 80       # Time in ms for M motors (DCMotor)
 
+# Switch positions are kept in the hub's storage, so a restart resumes from them
+POSITIONS_OFFSET = 16
+POSITIONS_MAGIC = 0x5A  # First byte of stored positions
+
 # Initialize constants
 switch_states = {
     "SWITCH_J": SWITCH_POSITION["STRAIGHT"]
 }
-processed_commands = set()
 status_number = 0
+applied_version = 0  # Version of the leader's desired positions this hub has converged to
+last_move_time = 0   # How long the last move of this hub's switches took in ms
+
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which is printed when the button stops the program, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(16)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
 
 # Initialize hub and motors
 hub = TechnicHub(broadcast_channel=SWITCH_STATUS_5, 
@@ -42,60 +83,108 @@ hub = TechnicHub(broadcast_channel=SWITCH_STATUS_5,
 switch_J = DCMotor(Port.A)  # Left switch, M motor
 print("Hub and motor initialized!")
 
-def move_switch(switch_name, position):
-    """Move switch and broadcast its new position"""
+def broadcast_status():
+    """Broadcast name-position pairs for the switches on this hub, then the applied version and last move time"""
     global status_number
+    status_number += 1
+    hub.ble.broadcast((status_number, 
+                      "J", switch_states["SWITCH_J"],
+                      "V", applied_version,
+                      "T", last_move_time))
+    save_positions()
+
+def load_positions():
+    """Resume from the switch positions stored by the last run; returns False if there are none"""
+    data = hub.system.storage(POSITIONS_OFFSET, read=2)
+    if data[0] != POSITIONS_MAGIC:
+        return False
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))  # Bit 0 is switch A
+        switch_states[switch_name] = 1 if data[1] & bit else 0
+    return True
+
+def save_positions():
+    """Keep the switch positions in the hub's storage to resume from them after a restart"""
+    mask = 0
+    for switch_name, position in switch_states.items():
+        if position:
+            mask |= 1 << (ord(switch_name[-1]) - ord("A"))
+    hub.system.storage(POSITIONS_OFFSET, write=bytes([POSITIONS_MAGIC, mask]))
+
+def move_switch(switch_name, position, report=True):
+    """Move switch and, unless report is False, broadcast the new positions"""
     
-    print("Moving {0} to {1} position!".format(
+    log(LOG_INFO, "Moving {0} to {1} position!".format(
         switch_name,
         "DIVERGING" if position else "STRAIGHT"
     ))
     
+    global last_move_time
     motor = switch_J
     power = MOTOR_POWER  # Left switch
         
+    timer = StopWatch()
     if position == SWITCH_POSITION["DIVERGING"]:
         motor.dc(power)
     else:  # STRAIGHT
         motor.dc(-power)
     wait(MOVE_TIME)
     motor.brake()
+    last_move_time = timer.time()
 
     # Update state and broadcast status as name-position pairs
     switch_states[switch_name] = position
-    status_number += 1
-    hub.ble.broadcast((status_number, 
-                      "J", switch_states["SWITCH_J"]))
+    if report:
+        broadcast_status()
+
+def reconcile(version, known, positions):
+    """
+    Converge this hub's switches to the leader's desired positions, given as bitmasks
+    (bit 0 is switch A): known has the switches the leader cares about, positions has
+    the diverging ones. Reports the version once the switches are there.
+    """
+    global applied_version
+    targets = []
+    for switch_name in switch_states:
+        bit = 1 << (ord(switch_name[-1]) - ord("A"))
+        position = 1 if positions & bit else 0
+        if known & bit and switch_states[switch_name] != position:
+            targets.append((switch_name, position))
+
+    if targets:
+        applied_version = version
+        for switch_name, position in targets:
+            move_switch(switch_name, position, report=False)
+        broadcast_status()
+    elif version != applied_version:
+        applied_version = version
+        broadcast_status()
 
 def check_commands():
     """Check for and handle any incoming commands"""
     cmd = hub.ble.observe(COMMAND_CHANNEL)
-    if cmd and len(cmd) >= 2:
-        command_number = cmd[0]
-        switch_name = cmd[1]
-        
-        if (switch_name in ["SWITCH_J"] and 
-            command_number not in processed_commands and 
-            len(cmd) == 3):
-            
-            position = cmd[2]
-            move_switch(switch_name, position)
-            processed_commands.add(command_number)
-            
-            if len(processed_commands) > 100:
-                oldest = min(processed_commands)
-                processed_commands.remove(oldest)
-
-# Initialize switches to STRAIGHT
-for name in switch_states:
-    print("Initializing {0} to STRAIGHT...".format(name))
-    move_switch(name, SWITCH_POSITION["STRAIGHT"])
+    if cmd and len(cmd) == 5 and cmd[1] == "DESIRED":
+        # The leader keeps its desired positions of all switches on air, so this
+        # is checked every time and also heals commands that were missed
+        reconcile(cmd[2], cmd[3], cmd[4])
+
+# Resume from the stored switch positions with a single status; without any, set all switches to STRAIGHT
+if load_positions():
+    print("Resumed switch positions: " +
+          ", ".join("{0} {1}".format(name, "DIVERGING" if switch_states[name] else "STRAIGHT")
+                    for name in switch_states))
+    broadcast_status()
+else:
+    for name in switch_states:
+        print("Initializing {0} to STRAIGHT...".format(name))
+        move_switch(name, SWITCH_POSITION["STRAIGHT"])
 
 print("Switch ready! Press button to stop.")
 
 while True:
     if hub.buttons.pressed():
         print("Detected button press: stopped.")
+        dump_log()
         break
 
     check_commands()
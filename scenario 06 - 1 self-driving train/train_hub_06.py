@@ -12,6 +12,7 @@ from pybricks.hubs import CityHub
 from pybricks.pupdevices import ColorDistanceSensor, DCMotor
 from pybricks.parameters import Color, Port
 from pybricks.tools import StopWatch, wait
+from micropython import const
 
 # Constants
 MOTOR_SPEED = 40           # Power in %
@@ -29,6 +30,41 @@ TRAIN_COMMAND = {
     "BACKWARD_UNTIL_PATTERN": 2
 }
 
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which the hub prints when the program stops, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(32)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
+
 # Clear terminal output
 print("\x1b[H\x1b[2J", end="")
 
@@ -98,10 +134,11 @@ def broadcast_status(movement_state, pattern_to_match=None):
         hub.ble.broadcast((status_number, TRAIN_NAME, current_code, movement_code, 0))
 
     # Print more detailed status locally
-    print(f"{TRAIN_NAME}: Broadcasting status #{status_number}: {movement_state}, " + 
-          f"seeing {current_color}" +
-          (f", looking for pattern {[TRAIN_COLOR_FROM_CODE[c] for c in pattern_to_match]}" 
-           if pattern_to_match else ""))
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, f"{TRAIN_NAME}: Broadcasting status #{status_number}: {movement_state}, " + 
+              f"seeing {current_color}" +
+              (f", looking for pattern {[TRAIN_COLOR_FROM_CODE[c] for c in pattern_to_match]}" 
+               if pattern_to_match else ""))
     broadcast_timer.reset()
 
 VALID_PATTERN_COLORS = {Color.RED, Color.YELLOW, Color.GREEN, Color.BLUE}
@@ -150,7 +187,7 @@ def move_until_pattern(direction, pattern_codes):
     """
     movement = "FORWARD" if direction > 0 else "BACKWARD"
     pattern = [TRAIN_COLOR_FROM_CODE[code] for code in pattern_codes]
-    print(f"{TRAIN_NAME}: Moving {movement} until pattern {pattern} detected...")
+    log(LOG_INFO, f"{TRAIN_NAME}: Moving {movement} until pattern {pattern} detected...")
     
     motor.dc(direction * MOTOR_SPEED)
     seen_colors = []
@@ -171,11 +208,12 @@ def move_until_pattern(direction, pattern_codes):
                     seen_colors.pop(0)
                 
                 stable_pattern = consolidate_colors(seen_colors)
-                print(f"Stable pattern: {stable_pattern}")
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, f"Stable pattern: {stable_pattern}")
                 
                 if len(stable_pattern) >= len(pattern):
                     if tuple(stable_pattern[-len(pattern):]) == tuple(pattern):
-                        print(f"Found pattern {pattern}!")
+                        log(LOG_INFO, f"Found pattern {pattern}!")
                         motor.brake()
                         broadcast_status("STOPPED", pattern_codes)
                         return True
@@ -199,7 +237,7 @@ def handle_command(cmd):
     if device_name == TRAIN_NAME and command_number not in processed_commands:
         if len(cmd) >= 3:
             command_type = cmd[2]
-            print(f"Received command #{command_number}: {command_type}")
+            log(LOG_INFO, f"Received command #{command_number}: {command_type}")
             
             if command_type == TRAIN_COMMAND["STOP"]:
                 motor.brake()
@@ -222,8 +260,12 @@ def handle_command(cmd):
 print(f"{TRAIN_NAME}: Ready! Listening for commands...")
 
 # Main loop - just listen for commands
-while True:
-    cmd = hub.ble.observe(COMMAND_CHANNEL)
-    if cmd:
-        handle_command(cmd)
-    wait(50) # Short delay so we don't busy-loop
+try:
+    while True:
+        cmd = hub.ble.observe(COMMAND_CHANNEL)
+        if cmd:
+            handle_command(cmd)
+        wait(50) # Short delay so we don't busy-loop
+finally:
+    # Show what happened, including debug messages, when the program is stopped
+    dump_log()
@@ -12,11 +12,24 @@ from pybricks.hubs import CityHub
 from pybricks.pupdevices import ColorDistanceSensor, DCMotor
 from pybricks.parameters import Color, Port
 from pybricks.tools import StopWatch, wait
+from micropython import const
 
 # Constants
-MOTOR_SPEED = 40           # Power in %
+MOTOR_SPEED = 40           # Power in % with the battery voltage at startup
 CHECK_INTERVAL = 35        # Time between color checks in ms
-BROADCAST_INTERVAL = 2000  # Time between status broadcasts in ms
+HEARTBEAT_INTERVAL = 10000 # ms after which the status is sent again when nothing happened
+HISTORY_LENGTH = 8         # Marker colors kept in the history sent with every status
+STALL_GAP_DEFAULT = 15000  # ms without a new marker that mean stuck, when the leader sent no limit with the move
+STALL_GAP_MIN = 3000       # ms without a new marker that are never taken for stuck
+
+# Speed control. The power is raised as the batteries drain, in proportion to the voltage drop,
+# and trimmed so the gaps between the markers of a pattern stay as long as at the start.
+MAX_POWER = 100            # %
+VOLTAGE_WEIGHT = 8         # A new voltage reading moves the average 1/8 of the way towards it
+REFERENCE_PATTERNS = 3     # Patterns found at startup power whose marker gaps set the target speed
+TRIM_WEIGHT = 4            # The speed trim moves 1/4 of the way to what the last pattern asked for
+TRIM_MIN = 80              # % of the power the trim may go down to
+TRIM_MAX = 130             # % of the power the trim may go up to
 
 # Broadcast channels
 COMMAND_CHANNEL = 1  # Leader -> Switch/train hubs
@@ -29,6 +42,41 @@ TRAIN_COMMAND = {
     "BACKWARD_UNTIL_PATTERN": 2
 }
 
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which the hub prints when the program stops, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(32)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
+
 # Clear terminal output
 print("\x1b[H\x1b[2J", end="")
 
@@ -39,10 +87,21 @@ motor = DCMotor(Port.A)
 sensor = ColorDistanceSensor(Port.B)
 print("Hub and devices initialized!")
 
+startup_voltage = hub.battery.voltage()  # mV that MOTOR_SPEED applies to
+battery_voltage = startup_voltage        # Average battery voltage in mV
+reference_gap = 0      # ms between pattern markers at the target speed, 0 until measured
+reference_count = 0    # Patterns that went into reference_gap
+speed_trim = 100       # % on top of the voltage compensation
+
 TRAIN_NAME = "TRAIN_BNSF"
 status_number = 0
 processed_commands = set()
+last_command = 0            # Number of the last command taken on, confirmed with every status
+current_movement = "STOPPED"
 broadcast_timer = StopWatch()
+marker_history = ""    # Codes of the last marker colors passed, oldest first, repeats collapsed
+history_direction = 1  # Direction the history was collected in: 1 forward, -1 backward
+longest_gap = 0        # Longest time between markers on the last move that found its pattern, in ms
 
 # Limit color palette because the color sensor is unreliable otherwise
 # on table
@@ -77,33 +136,85 @@ TRAIN_COLOR_FROM_CODE = {code: color for color, code in TRAIN_COLOR_CODES.items(
 TRAIN_MOVEMENT_CODES = {
     "STOPPED": 0,
     "FORWARD": 1,
-    "BACKWARD": 2
+    "BACKWARD": 2,
+    "STALLED": 3
 }
 
-def broadcast_status(movement_state, pattern_to_match=None):
-    """Broadcast current status including pattern information"""
-    global status_number
-    status_number += 1
+def broadcast_status(movement_state):
+    """
+    Broadcast current status: (status_num, current_color, movement, history, battery_mv, command_num, gap_ms).
+    The status channel tells the leader which train this is. The history is "F" or "B"
+    for the direction it was collected in, followed by the marker color codes, so the
+    leader can work out where the train is from the markers it passed last.
+    The command number tells the leader which command the movement belongs to, and the
+    longest gap between markers on the last move lets it learn the stall limit of the segment.
+    Statuses are sent on events (command taken on, marker passed, stopped, stalled)
+    and otherwise every HEARTBEAT_INTERVAL.
+    """
+    global status_number, current_movement
+    status_number = status_number % 32767 + 1  # Stays a 2-byte value so the status fits a broadcast
+    current_movement = movement_state
     current_color = sensor.color()
     current_code = TRAIN_COLOR_CODES[current_color]
     movement_code = TRAIN_MOVEMENT_CODES[movement_state]
+    history = ("F" if history_direction > 0 else "B") + marker_history
+    measure_battery()
 
-    # Include pattern info in status: (status_num, name, current_color, movement, pattern_length, *pattern)
-    if pattern_to_match:
-        # Send pattern length followed by pattern codes
-        hub.ble.broadcast((status_number, TRAIN_NAME, current_code, movement_code, 
-                          len(pattern_to_match)) + tuple(pattern_to_match))
-    else:
-        # No pattern when stopped
-        hub.ble.broadcast((status_number, TRAIN_NAME, current_code, movement_code, 0))
+    hub.ble.broadcast((status_number, current_code, movement_code, history, battery_voltage, last_command,
+                       longest_gap))
 
     # Print more detailed status locally
-    print(f"{TRAIN_NAME}: Broadcasting status #{status_number}: {movement_state}, " + 
-          f"seeing {current_color} with HSV {sensor.hsv()}" +
-          (f", looking for pattern {[TRAIN_COLOR_FROM_CODE[c] for c in pattern_to_match]}" 
-           if pattern_to_match else ""))
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, f"{TRAIN_NAME}: Broadcasting status #{status_number}: {movement_state}, " + 
+              f"seeing {current_color} with HSV {sensor.hsv()}, history {history}")
     broadcast_timer.reset()
 
+def remember_marker(color):
+    """Add a marker color to the history unless it's the one passed last. Returns True if it was added."""
+    global marker_history
+    code = str(TRAIN_COLOR_CODES[color])
+    if not marker_history or marker_history[-1] != code:
+        marker_history = (marker_history + code)[-HISTORY_LENGTH:]
+        return True
+    return False
+
+def measure_battery():
+    """Fold a new reading into the average battery voltage"""
+    global battery_voltage
+    battery_voltage += (hub.battery.voltage() - battery_voltage) // VOLTAGE_WEIGHT
+
+def motor_power():
+    """Power in % that gives the speed MOTOR_SPEED gave at startup"""
+    power = MOTOR_SPEED * startup_voltage // battery_voltage * speed_trim // 100
+    return min(power, MAX_POWER)
+
+def learn_speed(gaps):
+    """
+    Trim the power from the ms between the markers of a pattern just found.
+    The first patterns set the gap to hold; longer gaps later mean the train got slower.
+    """
+    global reference_gap, reference_count, speed_trim
+    if not gaps:
+        return
+    gap = sum(gaps) // len(gaps)
+    if reference_count < REFERENCE_PATTERNS:
+        reference_gap = (reference_gap * reference_count + gap) // (reference_count + 1)
+        reference_count += 1
+        return
+    wanted = speed_trim * gap // max(reference_gap, 1)
+    speed_trim = max(TRIM_MIN, min(TRIM_MAX, speed_trim + (wanted - speed_trim) // TRIM_WEIGHT))
+    log(LOG_INFO, f"{TRAIN_NAME}: Marker gap {gap} ms (target {reference_gap} ms), " +
+        f"battery {battery_voltage} mV, power {motor_power()}%")
+
+def stall_gap(stall_seconds):
+    """
+    ms without a new marker after which the train counts as stuck. The leader learns the
+    longest gaps between markers on each segment from the statuses, and sends the limit.
+    """
+    if not stall_seconds:
+        return STALL_GAP_DEFAULT
+    return max(stall_seconds * 1000, STALL_GAP_MIN)
+
 VALID_PATTERN_COLORS = {Color.RED, Color.YELLOW, Color.GREEN, Color.BLUE}
 
 def is_valid_color(color):
@@ -142,19 +253,33 @@ def consolidate_colors(color_history, min_repeats=2):
 
     return stable_colors
 
-def move_until_pattern(direction, pattern_codes):
+def move_until_pattern(direction, pattern_codes, stall_seconds=0):
     """
     Move train in specified direction until color pattern is found
     direction: 1 for forward, -1 for backward
     pattern_codes: list of color codes to look for in sequence
+    stall_seconds: longest time without a new marker, 0 if the leader doesn't know it yet
     """
+    global marker_history, history_direction, longest_gap
     movement = "FORWARD" if direction > 0 else "BACKWARD"
     pattern = [TRAIN_COLOR_FROM_CODE[code] for code in pattern_codes]
-    print(f"{TRAIN_NAME}: Moving {movement} until pattern {pattern} detected...")
+    log(LOG_INFO, f"{TRAIN_NAME}: Moving {movement} until pattern {pattern} detected...")
 
-    motor.dc(direction * MOTOR_SPEED)
+    if direction != history_direction:
+        # Markers are passed in the opposite order now, so the old history no longer fits
+        marker_history = ""
+        history_direction = direction
+
+    measure_battery()
+    motor.dc(direction * motor_power())
     seen_colors = []
-    broadcast_status(movement, pattern_codes)
+    broadcast_status(movement)
+
+    # A train that stalled or derailed passes no more markers
+    marker_timer = StopWatch()
+    stall_limit = stall_gap(stall_seconds)
+    move_gap = 0  # Longest time between markers on this move
+    gaps = []  # ms between the last markers, as many as the pattern has gaps
 
     while True:
         # Check for new commands (especially STOP)
@@ -163,6 +288,7 @@ def move_until_pattern(direction, pattern_codes):
             if handle_command(cmd):  # Returns True if we should stop
                 return False
 
+        new_marker = False
         if sensor.distance() < 15:
             current_color = sensor.color()
             if is_valid_color(current_color):
@@ -171,17 +297,36 @@ def move_until_pattern(direction, pattern_codes):
                     seen_colors.pop(0)
 
                 stable_pattern = consolidate_colors(seen_colors)
-                print(f"Stable pattern: {stable_pattern}")
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, f"Stable pattern: {stable_pattern}")
+                if stable_pattern and remember_marker(stable_pattern[-1]):
+                    new_marker = True
+                    gap = marker_timer.time()
+                    move_gap = max(move_gap, gap)
+                    marker_timer.reset()
+                    gaps.append(gap)
+                    if len(gaps) > len(pattern) - 1:
+                        gaps.pop(0)
 
                 if len(stable_pattern) >= len(pattern):
                     if tuple(stable_pattern[-len(pattern):]) == tuple(pattern):
-                        print(f"Found pattern {pattern}!")
+                        log(LOG_INFO, f"Found pattern {pattern}!")
                         motor.brake()
-                        broadcast_status("STOPPED", pattern_codes)
+                        longest_gap = min(move_gap, 32767)  # Stays a 2-byte value so the status fits a broadcast
+                        broadcast_status("STOPPED")
+                        learn_speed(gaps)
                         return True
 
-        if broadcast_timer.time() >= BROADCAST_INTERVAL:
-            broadcast_status(movement, pattern_codes)
+        if marker_timer.time() > stall_limit:
+            log(LOG_WARN, f"{TRAIN_NAME}: No new marker for {marker_timer.time()} ms, stalled!")
+            motor.brake()
+            broadcast_status("STALLED")
+            return False
+
+        # The leader sees the train's progress right away, and hears from it at least every heartbeat
+        if new_marker or broadcast_timer.time() >= HEARTBEAT_INTERVAL:
+            broadcast_status(movement)
+            motor.dc(direction * motor_power())  # Follow the battery voltage measured for the status
 
         wait(CHECK_INTERVAL)
 
@@ -189,6 +334,7 @@ def handle_command(cmd):
     """
     Process a command fully. Returns True if we should stop current movement.
     """
+    global last_command
     if not cmd or len(cmd) < 2:
         return False
 
@@ -199,31 +345,39 @@ def handle_command(cmd):
     if device_name == TRAIN_NAME and command_number not in processed_commands:
         if len(cmd) >= 3:
             command_type = cmd[2]
-            print(f"Received command #{command_number}: {command_type}")
+            log(LOG_INFO, f"Received command #{command_number}: {command_type}")
 
             if command_type == TRAIN_COMMAND["STOP"]:
                 motor.brake()
+                last_command = command_number
                 broadcast_status("STOPPED")
                 processed_commands.add(command_number)
                 return True
 
             elif command_type in [TRAIN_COMMAND["FORWARD_UNTIL_PATTERN"], 
                                 TRAIN_COMMAND["BACKWARD_UNTIL_PATTERN"]]:
-                if len(cmd) >= 4:  # Has pattern length
-                    pattern_length = cmd[3]
-                    if len(cmd) >= 4 + pattern_length:  # Has full pattern
-                        pattern = list(cmd[4:4+pattern_length])
-                        direction = 1 if command_type == TRAIN_COMMAND["FORWARD_UNTIL_PATTERN"] else -1
-                        processed_commands.add(command_number)
-                        move_until_pattern(direction, pattern)
+                # (command_number, train_name, command_type, stall_seconds) + pattern codes
+                if len(cmd) >= 5:  # Has stall limit and pattern
+                    pattern = list(cmd[4:])
+                    direction = 1 if command_type == TRAIN_COMMAND["FORWARD_UNTIL_PATTERN"] else -1
+                    processed_commands.add(command_number)
+                    last_command = command_number
+                    move_until_pattern(direction, pattern, cmd[3])
 
     return False
 
 print(f"{TRAIN_NAME}: Ready! Listening for commands...")
+broadcast_status("STOPPED")  # Let the leader know the train is there
 
-# Main loop - just listen for commands
-while True:
-    cmd = hub.ble.observe(COMMAND_CHANNEL)
-    if cmd:
-        handle_command(cmd)
-    wait(50) # Short delay so we don't busy-loop
+# Main loop - listen for commands, with a heartbeat while nothing happens
+try:
+    while True:
+        cmd = hub.ble.observe(COMMAND_CHANNEL)
+        if cmd:
+            handle_command(cmd)
+        if broadcast_timer.time() >= HEARTBEAT_INTERVAL:
+            broadcast_status(current_movement)
+        wait(50) # Short delay so we don't busy-loop
+finally:
+    # Show what happened, including debug messages, when the program is stopped
+    dump_log()
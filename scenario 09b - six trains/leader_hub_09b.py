@@ -10,7 +10,12 @@
 
 from pybricks.hubs import InventorHub
 from pybricks.parameters import Port, Color
-from pybricks.tools import wait
+from pybricks.tools import wait, StopWatch
+from micropython import const
+from usys import stdin
+from uselect import poll
+from ustruct import pack, unpack
+import gc
 
 ## works
 # (1) to route one train, e.g. the CSX from LA to NYC,
@@ -40,12 +45,60 @@ TRAIN_STATUS_BNSF = 24  # BNSF train -> leader
 TRAIN_STATUS_NS = 25    # NS train -> leader
 TRAIN_STATUS_METRO = 26 # Metro train -> leader
 
+# Train -> channel its hub reports on
+TRAIN_CHANNELS = {
+    "TRAIN_CSX": TRAIN_STATUS_CSX,
+    "TRAIN_UP": TRAIN_STATUS_UP,
+    "TRAIN_CN": TRAIN_STATUS_CN,
+    "TRAIN_BNSF": TRAIN_STATUS_BNSF,
+    "TRAIN_NS": TRAIN_STATUS_NS,
+    "TRAIN_METRO": TRAIN_STATUS_METRO
+}
+TRAIN_FROM_CHANNEL = {channel: train for train, channel in TRAIN_CHANNELS.items()}
+
+# Event loop timing
+LOOP_INTERVAL = 20    # ms between rounds of fleet servicing while waiting
+COMMAND_DWELL = 300   # ms each queued command stays on air before the next one replaces it
+
+# Send trains only the shortest end of each pattern that can't stop them early (see analyze_patterns).
+# The train still stops on the pattern's last marker, but needs fewer markers read correctly to get there.
+SHORTEN_PATTERNS = True
+
+# Fleet state freshness. Hubs keep broadcasting their last status, so a hub that
+# is running is heard on every poll; one that is not heard for a while is gone.
+STALE_AFTER = 3000    # ms without hearing a hub before its state counts as stale
+RATE_WINDOW = 10000   # ms over which the status rate of each hub is measured
+BATTERY_LOW = 6500    # mV below which a train's batteries should be replaced soon
+
+# Switch and dispatcher timing
+SWITCH_TIMEOUT = 10000    # ms for the switch hubs to confirm the desired positions, until their move times are known
+MOVEMENT_START = 1000     # ms to let a train start moving before checking for STOPPED, if it doesn't confirm commands
+MOVEMENT_TIMEOUT = 30000  # ms for a train to reach its pattern, until its travel time is known
+
+# Learned travel times. For every train and segment the leader keeps a moving average of
+# the ms from the command onto the segment until the train stopped in the next city, and
+# of how far the measurements are from that average. Once known, the planners cost that
+# segment by its travel time instead of its distance, and a move that takes longer than
+# the average plus TIMING_DEVIATIONS deviations plus some slack counts as failed.
+TIMING_WEIGHT = 4           # A new measurement moves the averages 1/4 of the way towards it
+TIMING_DEVIATIONS = 4       # Deviations above the average a move may take (about the 99th percentile)
+MOVEMENT_SLACK = 2000       # ms on top, for the statuses to reach the leader
+SWITCH_SLACK = 2000         # ms on top of a switch hub's move time, for the round trip of messages
+TRAVEL_TIMES_OFFSET = 0     # Where the learned times start in the hub's storage
+TRAVEL_TIMES_MAGIC = 0x7F   # First byte of stored travel times
+TRAVEL_TIME_SIZE = 4        # Bytes per train and segment: average and deviation in ms
+STORAGE_SIZE = 512          # Bytes of user storage on the hub
+
 # Switch positions
 SWITCH_POSITION = {
     "STRAIGHT": 0,
     "DIVERGING": 1
 }
 
+# The leader sets switches declaratively: it keeps (cmd_num, "DESIRED", version, known, positions)
+# on air, with one bit per switch A-J in the masks. Switch hubs move their switches to match
+# and add ("V", version) to their status once they have.
+
 # Train commands
 TRAIN_COMMAND = {
     "STOP": 0,
@@ -53,16 +106,19 @@ TRAIN_COMMAND = {
     "BACKWARD_UNTIL_PATTERN": 2
 }
 
-# Train movement codes (for status messages)
+# Train movement codes (for status messages).
+# A train reports STALLED when it stopped itself because it passed no markers for too long.
 TRAIN_MOVEMENT_CODES = {
     "STOPPED": 0,
     "FORWARD": 1,
-    "BACKWARD": 2
+    "BACKWARD": 2,
+    "STALLED": 3
 }
 TRAIN_MOVEMENT_FROM_CODE = {
     0: "STOPPED",
     1: "FORWARD",
-    2: "BACKWARD"
+    2: "BACKWARD",
+    3: "STALLED"
 }
 
 # Color codes (for status messages)
@@ -91,6 +147,44 @@ LOCATION_SEGMENT = "SEGMENT"
 ORIENTATION_FORWARD = "FORWARD"
 ORIENTATION_BACKWARD = "BACKWARD"
 
+# Holder of reservations for segments that failed and are avoided by the planners
+BLOCKED = "BLOCKED"
+
+# Logging
+# Log levels, most important first
+LOG_ERROR = const(0)
+LOG_WARN = const(1)
+LOG_INFO = const(2)
+LOG_DEBUG = const(3)
+LOG_LEVEL_NAMES = ("ERROR", "WARN", "INFO", "DEBUG")
+
+# Messages up to LOG_LEVEL are printed right away. Messages above LOG_LEVEL are only kept in the ring buffer,
+# which the 'log' command prints, so they cost no stdout time.
+LOG_LEVEL = LOG_INFO
+
+# Debug messages on hot paths are wrapped in `if LOG_HOT_PATHS:`.
+# With 0, MicroPython leaves those blocks out when it compiles the program.
+LOG_HOT_PATHS = const(0)
+
+LOG_BUFFER_SIZE = const(64)
+log_buffer = [None] * LOG_BUFFER_SIZE
+log_count = 0
+log_clock = StopWatch()
+
+def log(level, message):
+    """Keep a message in the ring buffer and print it if it's important enough"""
+    global log_count
+    log_buffer[log_count % LOG_BUFFER_SIZE] = (log_clock.time(), level, message)
+    log_count += 1
+    if level <= LOG_LEVEL:
+        print(message)
+
+def dump_log():
+    """Print the buffered messages, oldest first"""
+    for i in range(max(0, log_count - LOG_BUFFER_SIZE), log_count):
+        time, level, message = log_buffer[i % LOG_BUFFER_SIZE]
+        print(f"{time:>8} ms {LOG_LEVEL_NAMES[level]:<5} {message}")
+
 ###########################################
 # 2. TRACK LAYOUT DEFINITION
 ###########################################
@@ -311,6 +405,33 @@ track = {
     }
 }
 
+# Missions for batch mode ('b' command), run without prompts.
+# Each job moves one train to a goal city:
+# - "start" can be left out once the train's position is known from an earlier job
+# - "after" lists job ids that have to finish first
+# Jobs of the same train always run in the order listed. "repeat" runs the whole mission again.
+MISSIONS = {
+    # Three trains at once, as in test (5) above
+    "cross": {
+        "repeat": 1,
+        "jobs": [
+            {"id": "csx", "train": "CSX", "start": "LA", "goal": "KANSAS_CITY"},
+            {"id": "up", "train": "UP", "start": "KANSAS_CITY", "goal": "NYC"},
+            {"id": "cn", "train": "CN", "start": "CALGARY", "goal": "ATLANTA"}
+        ]
+    },
+    # CSX shuttles between LA and NYC; UP only leaves Calgary once CSX has reached NYC
+    "shuttle": {
+        "repeat": 3,
+        "jobs": [
+            {"id": "out", "train": "CSX", "start": "LA", "goal": "NYC"},
+            {"id": "back", "train": "CSX", "goal": "LA"},
+            {"id": "up_out", "train": "UP", "start": "CALGARY", "goal": "ATLANTA", "after": ["out"]},
+            {"id": "up_back", "train": "UP", "goal": "CALGARY"}
+        ]
+    }
+}
+
 ###########################################
 # 3. BASIC CLASSES AND HELPER FUNCTIONS
 ###########################################
@@ -390,6 +511,44 @@ class PriorityQueue:
         """Return True if queue is empty."""
         return len(self._items) == 0
 
+    def __len__(self):
+        return len(self._items)
+
+class SearchStats:
+    """Counters and timers collected during one find_paths search"""
+    def __init__(self):
+        self.nodes_expanded = 0    # States taken off the open list
+        self.nodes_generated = 0   # New states added to the open list
+        self.duplicate_hits = 0    # Generated states that were already visited
+        self.open_peak = 0         # Largest size of the open list
+        self.valid_moves_ms = 0    # Time spent in get_valid_moves
+        self.heuristic_ms = 0      # Time spent in heuristic
+        self.hashing_ms = 0        # Time spent hashing states for the visited set
+        self.total_ms = 0          # Time for the whole search
+        self.heap_before = None    # Free heap in bytes before and after the search
+        self.heap_after = None
+        self.solved = False
+
+    def show(self):
+        """Print all counters and timers"""
+        print(f"Search {'found a plan' if self.solved else 'found no plan'} in {self.total_ms} ms")
+        print(f"  Nodes expanded:   {self.nodes_expanded}")
+        print(f"  Nodes generated:  {self.nodes_generated}")
+        print(f"  Duplicate hits:   {self.duplicate_hits}")
+        print(f"  Open list peak:   {self.open_peak}")
+        print(f"  get_valid_moves:  {self.valid_moves_ms} ms")
+        print(f"  heuristic:        {self.heuristic_ms} ms")
+        print(f"  hashing:          {self.hashing_ms} ms")
+        if self.heap_before is not None:
+            print(f"  Free heap:        {self.heap_before} -> {self.heap_after} bytes")
+
+def free_heap():
+    """Free heap in bytes (only known when running on a hub)"""
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return None
+
 def compute_all_distances():
     distances = {}
     cities = set()
@@ -406,9 +565,10 @@ def compute_all_distances():
         distances[(city1, city2)] = dist
         distances[(city2, city1)] = dist
     
-    print("Initial distances:")
-    for (c1, c2), dist in sorted(distances.items()):
-        print(f"{c1}->{c2}: {dist}")
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, "Initial distances:")
+        for (c1, c2), dist in sorted(distances.items()):
+            log(LOG_DEBUG, f"{c1}->{c2}: {dist}")
     
     # Floyd-Warshall algorithm to find all shortest paths
     for k in cities:
@@ -420,9 +580,10 @@ def compute_all_distances():
                 if dist_ik + dist_kj < dist_ij:
                     distances[(i, j)] = dist_ik + dist_kj
     
-    print("\nFinal distances:")
-    for (c1, c2), dist in sorted(distances.items()):
-        print(f"{c1}->{c2}: {dist}")
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, "Final distances:")
+        for (c1, c2), dist in sorted(distances.items()):
+            log(LOG_DEBUG, f"{c1}->{c2}: {dist}")
     
     return distances
 
@@ -434,6 +595,21 @@ def get_min_distance(city1, city2):
         return 0
     return all_distances.get((city1, city2), float('inf'))
 
+def is_reserved(location, train):
+    """
+    True if a city or segment is part of another train's committed plan,
+    or the segment needs a switch that another train has claimed in the other position
+    """
+    holder = reservations.get(location)
+    if holder is not None and holder != train:
+        return True
+    if location in track:
+        for switch, position in track[location]["switches"].items():
+            claim = switch_claims.get(switch)
+            if claim and claim[0] != train and claim[1] != position:
+                return True
+    return False
+
 def get_connected_segments(city):
     """Get all segments that START at this city"""
     connected = []
@@ -445,6 +621,201 @@ def get_connected_segments(city):
             connected.append((city2, city1))
     return connected
 
+def as_pattern(pattern):
+    """A pattern as a tuple of colors, also when a single color was written without the tuple"""
+    if isinstance(pattern, tuple):
+        return pattern
+    return (pattern,)
+
+def pattern_key(pattern):
+    """A pattern as a string of color codes, the way train hubs report their marker history"""
+    return "".join(str(TRAIN_COLOR_CODES[color]) for color in as_pattern(pattern))
+
+def build_pattern_index():
+    """
+    Map the marker colors a train passes right before it stops to where it stops:
+    - approach pattern: on the segment
+    - at_city pattern: in the city at the end of the segment
+    - approach followed by at_city: also in that city, but tells more segments apart
+    Returns key -> list of the distinct Locations with that key.
+    """
+    index = {}
+    for segment, info in track.items():
+        approach = pattern_key(info["patterns"]["approach"])
+        at_city = pattern_key(info["patterns"]["at_city"])
+        for key, location in ((approach, Location(LOCATION_SEGMENT, segment)),
+                              (at_city, Location(LOCATION_CITY, segment[1])),
+                              (approach + at_city, Location(LOCATION_CITY, segment[1]))):
+            if not key:
+                continue  # Segment without an approach pattern
+            locations = index.setdefault(key, [])
+            if location not in locations:
+                locations.append(location)
+    return index
+
+def locate_train(history):
+    """
+    Work out where a stopped train is from the marker history in its status.
+    The longest recent run of markers that is a known key decides.
+    Returns (Location, orientation), or None if the history matches no place or several.
+    """
+    direction, codes = history[:1], history[1:]
+    for length in range(len(codes), 0, -1):
+        locations = pattern_index.get(codes[-length:])
+        if locations:
+            if len(locations) > 1:
+                return None
+            orientation = ORIENTATION_FORWARD if direction == "F" else ORIENTATION_BACKWARD
+            return locations[0], orientation
+    return None
+
+def departure_runs(segment):
+    """
+    The markers a train may read as it leaves a city onto segment. It starts on the last
+    marker of the at_city pattern it arrived on, and reads that pattern backwards when it
+    reverses to take segment.
+    """
+    city, destination = segment
+    runs = set()
+    for arrival, info in track.items():
+        key = pattern_key(info["patterns"]["at_city"])
+        if arrival[1] == city and key:
+            runs.add(key[::-1] if destination in info["reverse_for"] else key[-1])
+    return runs or {""}
+
+def stop_runs(segment, kind):
+    """Every run of markers a train may read on its way to a stop, ending with the stop's pattern"""
+    approach = pattern_key(track[segment]["patterns"]["approach"])
+    if kind == "approach" or not approach:
+        before = departure_runs(segment)
+    else:
+        before = {approach[-1]}  # It starts on the last marker of the approach
+    key = pattern_key(track[segment]["patterns"][kind])
+    return sorted(run + key for run in before)
+
+def stops_early(markers, runs):
+    """The runs in which a train looking for markers finds them before the end of the run"""
+    return [run for run in runs if run.find(markers) != len(run) - len(markers)]
+
+def analyze_patterns():
+    """
+    Check that every pattern stops trains where it should. A train stops as soon as the
+    markers it read since it started moving end with its pattern, so it stops early when
+    the pattern already occurs in the markers it passes on the way: leaving the city
+    (backwards if it reverses there) and, for at_city, the end of the approach.
+    Returns (problems, stop_patterns): problem messages and (segment, kind) -> pattern to
+    send, which is the shortest end of the pattern that can't stop a train early when
+    SHORTEN_PATTERNS is on.
+    """
+    problems = []
+    stop_patterns = {}
+    for segment, info in track.items():
+        for kind in ("approach", "at_city"):
+            pattern = as_pattern(info["patterns"][kind])
+            key = pattern_key(pattern)
+            if not key:
+                continue  # Segment without an approach pattern
+            runs = stop_runs(segment, kind)
+            early = stops_early(key, runs)
+            if early:
+                problems.append(f"{kind} of {segment} occurs early in markers {', '.join(early)}")
+            if early or not SHORTEN_PATTERNS:
+                stop_patterns[(segment, kind)] = pattern
+                continue
+
+            # At least two markers where the pattern has them, so that one misread color can't stop a train
+            for length in range(min(2, len(key)), len(key) + 1):
+                if not stops_early(key[-length:], runs):
+                    break
+            stop_patterns[(segment, kind)] = pattern[-length:]
+    return problems, stop_patterns
+
+def stop_pattern(segment, kind):
+    """The pattern that tells a train moving along segment to stop for kind ("approach" or "at_city")"""
+    return stop_patterns.get((segment, kind), track[segment]["patterns"][kind])
+
+def smooth_timing(timing, ms):
+    """
+    Move an (average, deviation) pair in ms towards a new measurement.
+    The first measurement starts with a deviation of half of it, so timeouts start out loose.
+    """
+    if not timing:
+        return (ms, ms // 2)
+    average, deviation = timing
+    deviation += (abs(ms - average) - deviation) // TIMING_WEIGHT
+    average += (ms - average) // TIMING_WEIGHT
+    return (average, deviation)
+
+def timing_limit(timing, slack, default):
+    """How long something with this (average, deviation) may take before it counts as failed"""
+    if not timing:
+        return default
+    average, deviation = timing
+    return min(average + TIMING_DEVIATIONS * deviation + slack, default)
+
+def segment_cost(train, segment):
+    """
+    Planner cost of a train taking a segment: its learned travel time, converted to distance
+    units at the fleet's average pace so it compares with the segments not learned yet
+    """
+    if travel_times:
+        timing = travel_times.get((train, segment))
+        if timing:
+            return timing[0] / travel_pace / 100.0
+    return track[segment]["distance"] / 100.0
+
+def update_travel_pace():
+    """Average ms per distance unit over all learned travel times"""
+    global travel_pace
+    total_ms = sum(average for average, _ in travel_times.values())
+    total_distance = sum(track[segment]["distance"] for _, segment in travel_times)
+    travel_pace = total_ms / total_distance if total_distance else 0
+
+def travel_time_slot(train, segment):
+    """Storage offset of a train's travel time on a segment (trains and segments in definition order)"""
+    index = list(TRAIN_CHANNELS).index(train) * len(track) + list(track).index(segment)
+    return TRAVEL_TIMES_OFFSET + 3 + TRAVEL_TIME_SIZE * index
+
+def travel_times_fit():
+    """True if a travel time for every train and segment fits in the hub's storage"""
+    return TRAVEL_TIMES_OFFSET + 3 + TRAVEL_TIME_SIZE * len(TRAIN_CHANNELS) * len(track) <= STORAGE_SIZE
+
+def learn_travel_time(train, segment, ms):
+    """Fold a measured traversal into the train's timing for the segment and store it"""
+    if train not in TRAIN_CHANNELS or segment not in track:
+        return
+    ms = min(ms, 0xFFFF)
+    timing = smooth_timing(travel_times.get((train, segment)), ms)
+    travel_times[(train, segment)] = timing
+    update_travel_pace()
+    log(LOG_INFO, f"{train} took {ms} ms for {segment[0]} -> {segment[1]}, " +
+        f"average {timing[0]} ms +/- {timing[1]} ms")
+    if travel_times_fit():
+        hub.system.storage(travel_time_slot(train, segment), write=pack("<HH", timing[0], timing[1]))
+
+def load_travel_times():
+    """Read the travel times learned in earlier runs, or start an empty table for this layout"""
+    if not travel_times_fit():
+        log(LOG_WARN, "Travel times don't fit in the hub's storage, they are only kept until restart")
+        return
+    size = TRAVEL_TIME_SIZE * len(TRAIN_CHANNELS) * len(track)
+    header = bytes([TRAVEL_TIMES_MAGIC, len(TRAIN_CHANNELS), len(track)])
+    data = hub.system.storage(TRAVEL_TIMES_OFFSET, read=3 + size)
+    if bytes(data[:3]) != header:
+        # Nothing stored yet, or stored for other trains or another layout
+        hub.system.storage(TRAVEL_TIMES_OFFSET, write=header + bytes(size))
+        log(LOG_INFO, "No travel times stored, planning by distance")
+        return
+    i = 3
+    for train in TRAIN_CHANNELS:
+        for segment in track:
+            average, deviation = unpack("<HH", data[i:i + TRAVEL_TIME_SIZE])
+            if average:
+                travel_times[(train, segment)] = (average, deviation)
+            i += TRAVEL_TIME_SIZE
+    update_travel_pace()
+    log(LOG_INFO, f"Loaded {len(travel_times)} learned travel times")
+
 ###########################################
 # 4. PATHFINDING IMPLEMENTATION
 ###########################################
@@ -485,18 +856,18 @@ def get_valid_moves(state, train, goals):
                             can_use = False
                             break
             
+            if can_use and reservations and is_reserved(segment, train):
+                can_use = False
+
             if can_use:
                 new_switches = {}
                 for switch, position in track[segment]["switches"].items():
                     new_switches[switch] = position
                 
-                # Get actual segment distance from track layout
-                segment_distance = track[segment]["distance"]
-                
                 valid_moves.append({
                     'location': Location(LOCATION_SEGMENT, segment),
                     'switches': new_switches,
-                    'cost': segment_distance / 100.0
+                    'cost': segment_cost(train, segment)
                 })
     
     else:  # Moving from segment to city
@@ -520,6 +891,9 @@ def get_valid_moves(state, train, goals):
                             can_use = False
                             break
                     
+            if can_use and reservations and is_reserved(end_city, train):
+                can_use = False
+
             if can_use:
                 valid_moves.append({
                     'location': Location(LOCATION_CITY, end_city),
@@ -546,15 +920,14 @@ def heuristic(state, goals):
     return total
 
 def get_move_cost(current_state, next_state, train, goals):
-    """Calculate move cost based on actual distances and switch changes"""
+    """Calculate move cost based on learned travel times or distances, and switch changes"""
     current_loc = current_state.trains[train].location
     next_loc = next_state.trains[train].location
     
     # Calculate distance cost
     if current_loc.type == LOCATION_CITY and next_loc.type == LOCATION_SEGMENT:
-        # Moving from city onto segment - use actual track distance
-        city1, city2 = next_loc.value
-        cost = track[(city1, city2)]["distance"] / 100.0  # Scale to reasonable cost
+        # Moving from city onto segment - use the train's travel time or the track distance
+        cost = segment_cost(train, next_loc.value)
     elif current_loc.type == LOCATION_SEGMENT and next_loc.type == LOCATION_CITY:
         # Moving from segment to city - cost already counted when entering segment
         cost = 0.0
@@ -570,7 +943,14 @@ def get_move_cost(current_state, next_state, train, goals):
     return cost
 
 def find_paths(initial_state, goals, max_depth=100):
-    """Find shortest paths using A* search with enhanced heuristics"""
+    """
+    Find shortest paths using A* search with enhanced heuristics.
+    Returns (path, stats): path is None if no plan was found, stats is a SearchStats.
+    """
+    stats = SearchStats()
+    stats.heap_before = free_heap()
+    timer = StopWatch()  # Per-call timings are summed in whole ms, which averages out over many calls
+
     queue = PriorityQueue()
     
     g = 0
@@ -583,11 +963,13 @@ def find_paths(initial_state, goals, max_depth=100):
     while not queue.empty() and states_explored < max_depth:
         g, current_state, path = queue.pop()
         states_explored += 1
+        stats.nodes_expanded = states_explored
         
-        print(f"\nExploring state {states_explored} (cost {g:.1f}):")
-        for train_name, train_state in current_state.trains.items():
-            if train_name in goals:
-                print(f"  {train_name}: {train_state.location.value}")
+        if LOG_HOT_PATHS:
+            log(LOG_DEBUG, f"Exploring state {states_explored} (cost {g:.1f}):")
+            for train_name, train_state in current_state.trains.items():
+                if train_name in goals:
+                    log(LOG_DEBUG, f"  {train_name}: {train_state.location.value}")
         
         # Check if we've reached goals
         all_at_goals = True
@@ -599,8 +981,11 @@ def find_paths(initial_state, goals, max_depth=100):
                 break
         
         if all_at_goals:
-            print(f"Found solution after exploring {states_explored} states")
-            return path + [current_state]
+            log(LOG_INFO, f"Found solution after exploring {states_explored} states")
+            stats.solved = True
+            stats.total_ms = timer.time()
+            stats.heap_after = free_heap()
+            return path + [current_state], stats
             
         # Try moving each train that isn't at its goal
         for train in goals:
@@ -609,7 +994,9 @@ def find_paths(initial_state, goals, max_depth=100):
                 train_state.location.value == goals[train]):
                 continue
                 
+            started = timer.time()
             moves = get_valid_moves(current_state, train, goals)
+            stats.valid_moves_ms += timer.time() - started
             
             for move in moves:
                 new_trains = current_state.trains.copy()
@@ -620,25 +1007,41 @@ def find_paths(initial_state, goals, max_depth=100):
                 
                 next_state = TrackState(new_trains, move['switches'])
                 
-                if next_state not in visited:
+                started = timer.time()
+                already_visited = next_state in visited
+                if not already_visited:
                     visited.add(next_state)
+                stats.hashing_ms += timer.time() - started
+
+                if already_visited:
+                    stats.duplicate_hits += 1
+                else:
                     new_g = g + get_move_cost(current_state, next_state, train, goals)
+                    started = timer.time()
                     new_h = heuristic(next_state, goals)
+                    stats.heuristic_ms += timer.time() - started
                     new_f = new_g + new_h
                     
-                    print(f"  Adding move (f={new_f:.1f}, h={new_h:.1f}):")
-                    print(f"    {train}: moves to {move['location'].value}")
+                    if LOG_HOT_PATHS:
+                        log(LOG_DEBUG, f"  Adding move (f={new_f:.1f}, h={new_h:.1f}): "
+                                       f"{train} moves to {move['location'].value}")
                     
                     queue.push((new_g, next_state, path + [current_state]), new_f)
+                    stats.nodes_generated += 1
+                    if len(queue) > stats.open_peak:
+                        stats.open_peak = len(queue)
     
-    print(f"Search stopped after exploring {states_explored} states")
-    return None
+    log(LOG_WARN, f"Search stopped after exploring {states_explored} states")
+    stats.total_ms = timer.time()
+    stats.heap_after = free_heap()
+    return None, stats
 
 def process_path_for_reversals(path, train, goal):
     """Process a path to determine where reversals are needed"""
     commands = []
     orientation = path[0].trains[train].orientation
-    print(f"\nDEBUG: Starting path processing for {train} with orientation {orientation}")
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, f"Starting path processing for {train} with orientation {orientation}")
     
     for i in range(len(path) - 1):
         current_state = path[i]
@@ -647,19 +1050,22 @@ def process_path_for_reversals(path, train, goal):
         curr_train = current_state.trains[train]
         next_train = next_state.trains[train]
         
-        print(f"\nDEBUG: Step {i}: Train {train} orientation={orientation}")
-        print(f"DEBUG: Current location: {curr_train.location.value}")
-        print(f"DEBUG: Next location: {next_train.location.value}")
+        if LOG_HOT_PATHS:
+            log(LOG_DEBUG, f"Step {i}: Train {train} orientation={orientation}")
+            log(LOG_DEBUG, f"Current location: {curr_train.location.value}")
+            log(LOG_DEBUG, f"Next location: {next_train.location.value}")
         
         # Only process if train actually moved
         if curr_train == next_train:
-            print("DEBUG: Train didn't move this step, continuing...")
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, "Train didn't move this step, continuing...")
             continue
         
         # Handle switch changes first
         if next_train.location.type == LOCATION_SEGMENT:
             segment = next_train.location.value
-            print(f"DEBUG: Moving onto segment {segment}")
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Moving onto segment {segment}")
             for switch, pos in track[segment]["switches"].items():
                 if switch not in current_state.switches or current_state.switches[switch] != pos:
                     commands.append({
@@ -672,14 +1078,16 @@ def process_path_for_reversals(path, train, goal):
         if next_train.location.type == LOCATION_SEGMENT:
             # Moving onto segment
             segment = next_train.location.value
-            print(f"DEBUG: Orientation when starting segment: {orientation}")
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Orientation when starting segment: {orientation}")
             commands.append({
                 'type': 'train',
                 'train': train,
                 'action': ("FORWARD_UNTIL_PATTERN" 
                           if orientation == ORIENTATION_FORWARD
                           else "BACKWARD_UNTIL_PATTERN"),
-                'pattern': track[segment]["patterns"]["approach"]
+                'pattern': stop_pattern(segment, "approach"),
+                'segment': segment
             })
 
         else:  # Moving to city
@@ -689,8 +1097,9 @@ def process_path_for_reversals(path, train, goal):
             # Moving to city - get current segment and pattern
             current_segment = curr_train.location.value
             last_segment = current_segment  # Store it before we lose it
-            print(f"DEBUG: Moving to city {next_train.location.value} from segment {current_segment}")
-            pattern = track[current_segment]["patterns"]["at_city"]
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Moving to city {next_train.location.value} from segment {current_segment}")
+            pattern = stop_pattern(current_segment, "at_city")
 
             # First, add command to reach the city
             commands.append({
@@ -699,110 +1108,299 @@ def process_path_for_reversals(path, train, goal):
                 'action': ("FORWARD_UNTIL_PATTERN"
                           if orientation == ORIENTATION_FORWARD
                           else "BACKWARD_UNTIL_PATTERN"),
-                'pattern': pattern
+                'pattern': pattern,
+                'segment': current_segment,
+                'arrives': next_train.location.value
             })
 
             # Now look ahead to find the next segment
-            print(f"DEBUG: About to start look-ahead scan from i={i}, path length={len(path)}")
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"About to start look-ahead scan from i={i}, path length={len(path)}")
             next_segment_found = False
             scan_idx = i + 2  # Start looking 2 states ahead
             while scan_idx < len(path):
-                print(f"DEBUG: Scanning state {scan_idx}")
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, f"Scanning state {scan_idx}")
                 scan_state = path[scan_idx].trains[train]
-                print(f"DEBUG: Found location type: {scan_state.location.type}")
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, f"Found location type: {scan_state.location.type}")
                 if scan_state.location.type == LOCATION_SEGMENT:
                     next_segment_found = True
                     next_segment = scan_state.location.value
-                    print(f"DEBUG: Found next segment: {next_segment}")
+                    if LOG_HOT_PATHS:
+                        log(LOG_DEBUG, f"Found next segment: {next_segment}")
                     # Get where we're ultimately going in this next segment
                     current_city = next_train.location.value
                     destination_city = (next_segment[1] if next_segment[0] == current_city 
                                       else next_segment[0])
-                    print(f"DEBUG: Last segment {last_segment} reverse_for list: {track[last_segment]['reverse_for']}")
-                    print(f"DEBUG: Next segment {next_segment} goes from {next_segment[0]} to {next_segment[1]}")
-                    print(f"DEBUG: Current city is {current_city}, next destination is {destination_city}")
+                    if LOG_HOT_PATHS:
+                        log(LOG_DEBUG, f"Last segment {last_segment} reverse_for list: {track[last_segment]['reverse_for']}")
+                        log(LOG_DEBUG, f"Next segment {next_segment} goes from {next_segment[0]} to {next_segment[1]}")
+                        log(LOG_DEBUG, f"Current city is {current_city}, next destination is {destination_city}")
                     needs_reversal = destination_city in track[last_segment]["reverse_for"]
-                    print(f"DEBUG: {destination_city} in reverse_for list? {needs_reversal}")
-                    print(f"DEBUG: Current orientation is {orientation}")
-                    print(f"DEBUG: Will need reversal? {needs_reversal != (orientation == ORIENTATION_BACKWARD)}")
+                    if LOG_HOT_PATHS:
+                        log(LOG_DEBUG, f"{destination_city} in reverse_for list? {needs_reversal}")
+                        log(LOG_DEBUG, f"Current orientation is {orientation}")
+                        log(LOG_DEBUG, f"Will need reversal? {needs_reversal != (orientation == ORIENTATION_BACKWARD)}")
                     if needs_reversal != (orientation == ORIENTATION_BACKWARD):
-                        print("DEBUG: Adding reverse command")
+                        if LOG_HOT_PATHS:
+                            log(LOG_DEBUG, "Adding reverse command")
                         commands.append({'type': 'reverse'})
                         orientation = ORIENTATION_BACKWARD if needs_reversal else ORIENTATION_FORWARD
                         next_state.trains[train].orientation = orientation
-                        print(f"DEBUG: New orientation is {orientation}")
+                        if LOG_HOT_PATHS:
+                            log(LOG_DEBUG, f"New orientation is {orientation}")
                     break
                 scan_idx += 1
 
             if not next_segment_found:
-                print("DEBUG: No next segment found - this must be the last move")
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, "No next segment found - this must be the last move")
 
     return commands
 
+class RouteRepair:
+    """
+    D* Lite over the city graph for one train. It searches backwards from the goal, so when
+    segments or cities become blocked only the costs they affect are recomputed and the
+    route can be repaired from wherever the train is now.
+    """
+    def __init__(self, start, goal):
+        self.start = start
+        self.goal = goal
+        self.km = 0               # Heuristic offset from moving the start
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.open = {}            # City -> key
+        self.blocked_segments = set()
+        self.blocked_cities = set()
+        self.expansions = 0
+        self.successors = {}
+        self.predecessors = {}
+        for city1, city2 in track:
+            self.successors.setdefault(city1, []).append(city2)
+            self.predecessors.setdefault(city2, []).append(city1)
+        self.open[goal] = self.key(goal)
+        self.compute()
+
+    def h(self, city):
+        return get_min_distance(self.start, city) / 100.0
+
+    def cost(self, city1, city2):
+        if ((city1, city2) in self.blocked_segments or
+            city1 in self.blocked_cities or city2 in self.blocked_cities):
+            return float('inf')
+        return track[(city1, city2)]["distance"] / 100.0
+
+    def key(self, city):
+        best = min(self.g.get(city, float('inf')), self.rhs.get(city, float('inf')))
+        return (best + self.h(city) + self.km, best)
+
+    def update(self, city):
+        if city != self.goal:
+            self.rhs[city] = min([self.cost(city, next_city) + self.g.get(next_city, float('inf'))
+                                  for next_city in self.successors.get(city, [])] + [float('inf')])
+        self.open.pop(city, None)
+        if self.g.get(city, float('inf')) != self.rhs.get(city, float('inf')):
+            self.open[city] = self.key(city)
+
+    def compute(self):
+        """Expand cities until the start's cost is settled"""
+        while self.open:
+            city = min(self.open, key=self.open.get)
+            old_key = self.open[city]
+            if (old_key >= self.key(self.start) and
+                self.rhs.get(self.start, float('inf')) == self.g.get(self.start, float('inf'))):
+                break
+            self.expansions += 1
+            new_key = self.key(city)
+            if old_key < new_key:
+                self.open[city] = new_key
+            elif self.g.get(city, float('inf')) > self.rhs.get(city, float('inf')):
+                self.g[city] = self.rhs[city]
+                del self.open[city]
+                for prev_city in self.predecessors.get(city, []):
+                    self.update(prev_city)
+            else:
+                self.g[city] = float('inf')
+                for prev_city in self.predecessors.get(city, []) + [city]:
+                    self.update(prev_city)
+
+    def move_to(self, city):
+        """The train has reached city; later repairs start from there"""
+        self.km += self.h(city)
+        self.start = city
+
+    def set_blocked(self, segments, cities):
+        """Replace the blocked segments and cities and repair the costs they affect"""
+        changed = self.blocked_segments ^ set(segments)
+        for city in self.blocked_cities ^ set(cities):
+            changed.update((prev_city, city) for prev_city in self.predecessors.get(city, []))
+            changed.update((city, next_city) for next_city in self.successors.get(city, []))
+        self.blocked_segments = set(segments)
+        self.blocked_cities = set(cities)
+        for city1, _ in changed:
+            self.update(city1)
+        self.compute()
+
+    def route(self):
+        """Cities from the start to the goal, or None if the goal can't be reached"""
+        if self.g.get(self.start, float('inf')) == float('inf'):
+            return None
+        cities = [self.start]
+        while cities[-1] != self.goal and len(cities) <= len(self.successors):
+            city = cities[-1]
+            cities.append(min(self.successors[city],
+                              key=lambda next_city: self.cost(city, next_city) + self.g.get(next_city, float('inf'))))
+        return cities if cities[-1] == self.goal else None
+
 ###########################################
 # 5. COMMAND EXECUTION
 ###########################################
 
-def send_switch_command(switch_name, position):
-    """Send command to switch"""
-    global command_number
-    command_number += 1
-    position_str = 'DIVERGING' if position else 'STRAIGHT'
-    print(f"Sending command #{command_number}: {switch_name} -> {position_str}")
-    hub.ble.broadcast((command_number, switch_name, position))
+def layout_switches():
+    """Names of the switches the track layout uses"""
+    return {switch for segment in track.values() for switch in segment["switches"]}
 
-def wait_for_switch_update(switch_name, target_position, command_number, timeout=5000):
-    """Wait for switch status update confirming the switch reached desired position"""
-    print(f"Waiting for {switch_name} to reach {'DIVERGING' if target_position else 'STRAIGHT'} position...")
+def set_desired(settings):
+    """
+    Change the desired positions of some switches. The whole vector of desired positions
+    goes on air whenever no other command is, and the switch hubs keep converging to it.
+    Returns the version that confirms the new positions.
+    """
+    global desired_version, desired_message, command_number
+    switches = layout_switches()
+    for switch, position in settings:
+        if switch not in switches:
+            raise ValueError(f"Unknown switch {switch}")
+    changed = [(switch, position) for switch, position in settings
+               if desired_switches.get(switch) != position]
+    if not changed:
+        return desired_version
 
-    # Record current number of statuses we've processed
-    initial_status_count = len(processed_statuses)
+    for switch, position in changed:
+        desired_switches[switch] = position
+    desired_version += 1
+    command_number += 1
 
-    interval = 100  # Check every 100ms
-    elapsed = 0
+    # One bit per switch, bit 0 is switch A
+    known = 0
+    positions = 0
+    for switch, position in desired_switches.items():
+        bit = 1 << (ord(switch[-1]) - ord("A"))
+        known |= bit
+        if position:
+            positions |= bit
+    desired_message = (command_number, "DESIRED", desired_version, known, positions)
+    log(LOG_INFO, f"Desired switches v{desired_version}: " +
+                  ", ".join(f"{name} -> {'DIVERGING' if pos else 'STRAIGHT'}" for name, pos in changed))
+    service_command_queue()
+    return desired_version
 
-    while elapsed < timeout:
-        check_status_updates()
+def switches_confirmed(targets, version):
+    """True once the switch hubs report every (switch, position) in targets, having applied version"""
+    for switch, position in targets:
+        if switch_states.get(switch) != position or switch_versions.get(switch, 0) < version:
+            return False
+    return True
 
-        # Check if we've received any new status updates since sending command
-        if len(processed_statuses) > initial_status_count:
-            if (switch_name in switch_states and
-                switch_states[switch_name] == target_position):
-                print(f"{switch_name} reached desired position!")
-                return True
+def switch_timeout(targets):
+    """ms the hubs of the switches in targets get to confirm them, from how long their moves take"""
+    timeout = SWITCH_SLACK
+    for switch, _ in targets:
+        channel = switch_channels.get(switch)
+        timeout = max(timeout, timing_limit(switch_timings.get(channel), SWITCH_SLACK, SWITCH_TIMEOUT))
+    return timeout
 
-        wait(interval)
-        elapsed += interval
+def wait_for_switches(targets, version):
+    """Wait for status updates confirming every (switch, position) in targets"""
+    names = ", ".join(switch_name for switch_name, _ in targets)
+    timeout = switch_timeout(targets)
+    log(LOG_DEBUG, f"Waiting up to {timeout} ms for {names} to reach their positions...")
 
-    print(f"Warning: Timed out waiting for {switch_name} status update!")
-    return False
+    timer = StopWatch()
+    while timer.time() < timeout:
+        service_fleet()
+        if switches_confirmed(targets, version):
+            log(LOG_DEBUG, f"{names} reached desired positions!")
+            return True
+        wait(LOOP_INTERVAL)
 
-def execute_switch_command(switch_name, position, max_retries=3):
-    """Send switch command and verify it worked, with retries if needed"""
-    global command_number
+    log(LOG_WARN, f"Timed out waiting for {names} status update!")
+    return False
 
-    for attempt in range(max_retries):
-        if attempt > 0:
-            print(f"Retry attempt {attempt}/{max_retries-1}...")
+def execute_switch_settings(settings):
+    """
+    Set several switches through the desired positions and wait until their hubs confirm them.
+    The hubs move their switches in parallel, and lost messages heal while the desired
+    positions stay on air, so there is nothing to retry.
+    Returns the switches that didn't confirm their position.
+    """
+    version = set_desired(settings)
+    if wait_for_switches(settings, version):
+        return []
+    return [name for name, pos in settings if not switches_confirmed([(name, pos)], version)]
 
-        # Send command
-        send_switch_command(switch_name, position)
-        command_num = command_number  # Save command number for verification
-        wait(500)
+def send_calibrate():
+    """Ask the switch hubs to calibrate their L motor switches (B, E, G, I); they store the results"""
+    global command_number
+    command_number += 1
+    log(LOG_INFO, f"Sending command #{command_number}: CALIBRATE")
+    queue_command((command_number, "CALIBRATE"))
 
-        # Wait for status update from this specific command
-        if wait_for_switch_update(switch_name, position, command_num):
-            return True
+def lookahead_switches(commands, start, train, segment):
+    """
+    Switch settings for the train's next segment that can be made while it is still on segment.
+    Scans commands[start:] up to the train's move onto its next segment. Leaves out switches of the
+    current segment and switches another train still needs in another position: in its commands
+    before that move, or on the segment it is on or moving onto.
+    """
+    wanted = {}
+    needed = {}
+    ahead = True
+    seen = set()
+    for cmd in commands[start:]:
+        owner = cmd.get('train', train)
+        if owner == train:
+            if not ahead:
+                continue
+            if cmd['type'] == 'train' and cmd['segment'] != segment:
+                ahead = False
+            elif cmd['type'] == 'switch':
+                wanted[cmd['switch']] = cmd['position']
+            continue
+        if not ahead and owner in seen:
+            continue
+        if cmd['type'] == 'switch':
+            needs = {cmd['switch']: cmd['position']}
+        elif 'segment' in cmd:
+            needs = track[cmd['segment']]["switches"]
+            seen.add(owner)
+        else:
+            continue
+        for switch, position in needs.items():
+            if needed.get(switch, position) != position:
+                needed[switch] = None  # Needed both ways, leave it alone
+            else:
+                needed[switch] = position
 
-        # If we reach here, the switch didn't report success
-        if attempt < max_retries - 1:  # If we have retries left
-            print(f"Switch {switch_name} didn't reach position, retrying...")
-            wait(1000)  # Wait before retry
+    current = track[segment]["switches"]
+    return [(switch, position) for switch, position in wanted.items()
+            if switch_states.get(switch) != position and switch not in current
+            and needed.get(switch, position) == position]
 
-    return False
+def preposition_switches(settings):
+    """Ask for the next segment's switch settings while the train is still moving, without waiting"""
+    if settings:
+        log(LOG_INFO, f"Pre-positioning {', '.join(switch for switch, _ in settings)}")
+        set_desired(settings)
 
-def send_train_command(train_name, command_type, pattern=None):
-    """Send command to train"""
+def send_train_command(train_name, command_type, pattern=None, stall_seconds=0):
+    """
+    Send command to train. Returns the command number the train confirms it with.
+    Moves carry the seconds the train may go without a new marker (0 if not known yet)
+    before the pattern codes, which take the rest of the broadcast.
+    """
     global command_number
     command_number += 1
     
@@ -810,55 +1408,290 @@ def send_train_command(train_name, command_type, pattern=None):
                        TRAIN_COMMAND["BACKWARD_UNTIL_PATTERN"]]:
         pattern_codes = [TRAIN_COLOR_CODES[color] for color in pattern]
         command = (command_number, train_name, command_type, 
-                  len(pattern_codes)) + tuple(pattern_codes)
+                  stall_seconds) + tuple(pattern_codes)
     else:
         command = (command_number, train_name, command_type)
     
     pattern_str = f", pattern={pattern}" if pattern else ""
-    print(f"Sending command #{command_number}: {train_name} -> {command_type}{pattern_str}")
-    hub.ble.broadcast(command)
+    log(LOG_INFO, f"Sending command #{command_number}: {train_name} -> {command_type}{pattern_str}")
+    queue_command(command)
+    return command_number
+
+def handle_switch_status(channel, status):
+    """Process pairs of (switch_letter, position), then ("V", applied version) and ("T", move time in ms)"""
+    names = []
+    for i in range(1, len(status) - 1, 2):
+        key = status[i]
+        value = status[i+1]
+        if key == "V":
+            for switch_name in names:
+                switch_versions[switch_name] = value
+            continue
+        if key == "T":
+            # Hubs repeat their last move time in every status, and 0 before their first move
+            if value and value != switch_move_times.get(channel):
+                switch_timings[channel] = smooth_timing(switch_timings.get(channel), value)
+            switch_move_times[channel] = value
+            if LOG_HOT_PATHS:
+                log(LOG_DEBUG, f"Switch hub on channel {channel} took {value} ms")
+            continue
+        switch_name = "SWITCH_" + key
+        switch_states[switch_name] = value
+        switch_channels[switch_name] = channel
+        names.append(switch_name)
+        if LOG_HOT_PATHS:
+            log(LOG_DEBUG, f"Updated {switch_name} to {'DIVERGING' if value else 'STRAIGHT'}")
+
+def handle_train_status(channel, status):
+    """
+    Record a train's color, movement, marker history, battery voltage, the command it's carrying out
+    and the longest gap between markers on its last move: (status_num, current_color, movement,
+    history, battery_mv, command_num, gap_ms).
+    A stopped train is located from its history.
+    """
+    train_name = TRAIN_FROM_CHANNEL[channel]
+    color_code = status[1]
+    movement_code = status[2]
+
+    state = {
+        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
+        'color': TRAIN_COLOR_FROM_CODE[color_code],
+        'history': status[3] if len(status) > 3 else "",
+        'battery': status[4] if len(status) > 4 else None,
+        'command': status[5] if len(status) > 5 else None,
+        'gap': status[6] if len(status) > 6 else None
+    }
+    if state['battery'] and state['battery'] < BATTERY_LOW:
+        if train_states.get(train_name, {}).get('battery', BATTERY_LOW) >= BATTERY_LOW:
+            log(LOG_WARN, f"{train_name} battery is low ({state['battery']} mV)")
+    if state['movement'] == "STOPPED":
+        located = locate_train(state['history'])
+        if located:
+            state['location'], state['orientation'] = located
+    train_states[train_name] = state
+
+    if LOG_HOT_PATHS:
+        log(LOG_DEBUG, f"Updated {train_name} status: {train_states[train_name]['movement']}")
+
+# Status channel -> function that processes the statuses broadcast on it
+STATUS_HANDLERS = {
+    SWITCH_STATUS_1: handle_switch_status,
+    SWITCH_STATUS_2: handle_switch_status,
+    SWITCH_STATUS_3: handle_switch_status,
+    SWITCH_STATUS_4: handle_switch_status,
+    SWITCH_STATUS_5: handle_switch_status,
+    TRAIN_STATUS_CSX: handle_train_status,
+    TRAIN_STATUS_UP: handle_train_status,
+    TRAIN_STATUS_CN: handle_train_status,
+    TRAIN_STATUS_BNSF: handle_train_status,
+    TRAIN_STATUS_NS: handle_train_status,
+    TRAIN_STATUS_METRO: handle_train_status,
+}
+STATUS_SOURCES = tuple(STATUS_HANDLERS.items())  # Built once so polling allocates nothing
 
 def check_status_updates():
-    """Check for status updates from all hubs"""
-    for channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                   SWITCH_STATUS_4, SWITCH_STATUS_5, TRAIN_STATUS_CSX,
-                   TRAIN_STATUS_UP, TRAIN_STATUS_CN, TRAIN_STATUS_BNSF,
-                   TRAIN_STATUS_NS, TRAIN_STATUS_METRO]:
+    """Check for status updates from all hubs and keep the fleet state current"""
+    global dispatch_changed
+    now = fleet_clock.time()
+    for channel, handler in STATUS_SOURCES:
         status = hub.ble.observe(channel)
-        
+        device = fleet[channel]
+
         if status and len(status) >= 2:
-            status_number = status[0]
-            status_id = (channel, status_number)
-            
-            if status_id not in processed_statuses:
-                print(f"Processing new status #{status_number} from channel {channel}")
-                
-                if channel in [SWITCH_STATUS_1, SWITCH_STATUS_2, SWITCH_STATUS_3, 
-                             SWITCH_STATUS_4, SWITCH_STATUS_5]:
-                    # Process pairs of (switch_letter, position)
-                    for i in range(1, len(status), 2):
-                        switch_letter = status[i]
-                        position = status[i+1]
-                        switch_name = "SWITCH_" + switch_letter
-                        switch_states[switch_name] = position
-                        print(f"Updated {switch_name} to {'DIVERGING' if position else 'STRAIGHT'}")
-                
-                elif channel in [TRAIN_STATUS_CSX, TRAIN_STATUS_UP, TRAIN_STATUS_CN, TRAIN_STATUS_BNSF, TRAIN_STATUS_NS, TRAIN_STATUS_METRO]:
-                    train_name = status[1]
-                    color_code = status[2]
-                    movement_code = status[3]
-                    
-                    train_states[train_name] = {
-                        'movement': TRAIN_MOVEMENT_FROM_CODE[movement_code],
-                        'color': TRAIN_COLOR_FROM_CODE[color_code]
-                    }
-                    
-                    print(f"Updated {train_name} status")
-                
-                processed_statuses.add(status_id)
-            
-            if len(processed_statuses) > 100:
-                processed_statuses.clear()
+            device['heard'] = now
+            # Each hub counts its statuses up, so any number other than the last one
+            # seen on the channel is new. This also covers a counter that wrapped or
+            # a hub that restarted and counts from 1 again.
+            if status[0] != last_status.get(channel):
+                last_status[channel] = status[0]
+                device['count'] += 1
+                if LOG_HOT_PATHS:
+                    log(LOG_DEBUG, f"Processing new status #{status[0]} from channel {channel}")
+                handler(channel, status)
+
+        if now - device['window'] >= RATE_WINDOW:
+            device['rate'] = device['count'] * 60000 // (now - device['window'])
+            device['count'] = 0
+            device['window'] = now
+
+        fresh = device['heard'] is not None and now - device['heard'] <= STALE_AFTER
+        if fresh != device['fresh']:
+            device['fresh'] = fresh
+            if fresh:
+                log(LOG_INFO, f"{device_name(channel)} is reporting")
+                dispatch_changed = True  # Its queued jobs can be planned now
+            else:
+                log(LOG_WARN, f"{device_name(channel)} went silent")
+
+def device_name(channel):
+    """Name of the hub that reports on a status channel"""
+    if channel in TRAIN_FROM_CHANNEL:
+        return TRAIN_FROM_CHANNEL[channel]
+    return f"Switch hub {channel - SWITCH_STATUS_1 + 1}"
+
+def located_position(train, cities_only=False):
+    """Where the train was last located from its markers: a city, a segment or None"""
+    state = train_states.get(train, {})
+    if 'location' not in state:
+        return None
+    if cities_only and state['location'].type != LOCATION_CITY:
+        return None
+    return state['location'].value
+
+def start_orientation(train, position):
+    """The orientation the train was located with, if it's still at that position"""
+    state = train_states.get(train, {})
+    if 'location' in state and state['location'].value == position:
+        return state['orientation']
+    return ORIENTATION_FORWARD
+
+def record_move(train, cmd, ms):
+    """
+    Time a train's moves along a segment: the move onto the segment is kept until the
+    move into the next city completes, then the two together are learned. The longest
+    gap between markers the train reports for each move is learned right away.
+    """
+    if 'segment' not in cmd:
+        return
+    gap = train_states.get(train, {}).get('gap')
+    if gap and train in TRAIN_CHANNELS:
+        marker_gaps[(train, cmd['segment'])] = smooth_timing(marker_gaps.get((train, cmd['segment'])), gap)
+    if 'arrives' not in cmd:
+        segment_moves[train] = (cmd['segment'], ms)
+        return
+    segment, approach_ms = segment_moves.pop(train, (None, 0))
+    if segment == cmd['segment']:
+        learn_travel_time(train, segment, approach_ms + ms)
+
+def move_result(train, number, elapsed):
+    """
+    "STOPPED" or "STALLED" once the train finished the move of command number, else None.
+    Trains send the number of the command they are carrying out with every status, so a
+    STOPPED left over from the previous move can't end this one early. Trains that don't
+    send it get MOVEMENT_START ms to report that they started moving.
+    """
+    state = train_states.get(train)
+    if not state:
+        return None
+    if state.get('command') is None:
+        if elapsed < MOVEMENT_START:
+            return None
+    elif state['command'] != number:
+        return None
+    if state['movement'] in ("STOPPED", "STALLED"):
+        return state['movement']
+    return None
+
+def move_timeout(train, cmd):
+    """
+    ms a train gets for a move. The learned travel time covers the whole segment,
+    so the move into the city only gets what the move onto the segment left over.
+    """
+    if 'segment' not in cmd:
+        return MOVEMENT_TIMEOUT
+    timeout = timing_limit(travel_times.get((train, cmd['segment'])), MOVEMENT_SLACK, MOVEMENT_TIMEOUT)
+    if 'arrives' in cmd and timeout < MOVEMENT_TIMEOUT:
+        segment, approach_ms = segment_moves.get(train, (None, 0))
+        if segment == cmd['segment']:
+            timeout = max(timeout - approach_ms, MOVEMENT_START + MOVEMENT_SLACK)
+    return timeout
+
+def stall_seconds(train, cmd):
+    """
+    Whole seconds a train may go without a new marker on a move, from the longest gaps
+    between markers it had on the segment before. 0 while those aren't learned.
+    Capped by MOVEMENT_TIMEOUT, so it stays a 1-byte value and the command fits a broadcast.
+    """
+    timing = marker_gaps.get((train, cmd.get('segment')))
+    if not timing:
+        return 0
+    return -(-timing_limit(timing, 0, MOVEMENT_TIMEOUT) // 1000)
+
+def stale_trains(trains):
+    """The trains whose hub has not been heard from recently (or ever, for unknown trains)"""
+    return [train for train in trains
+            if train not in TRAIN_CHANNELS or not fleet[TRAIN_CHANNELS[train]]['fresh']]
+
+def queue_command(command):
+    """Queue a command for broadcast; service_fleet puts it on air"""
+    outgoing_commands.append(command)
+    service_command_queue()
+
+def service_command_queue():
+    """
+    Broadcast the next queued command once the current one has been on air long enough.
+    The leader has a single broadcast, so sending right away would overwrite a command
+    before the hubs have had a chance to observe it. With nothing queued, the train
+    commands their trains haven't confirmed yet take turns on air with the desired
+    switch positions, so a train that missed its command still gets it.
+    """
+    global on_air
+    if command_clock.time() < COMMAND_DWELL:
+        return
+    if outgoing_commands:
+        on_air = outgoing_commands.pop(0)
+        if on_air[1] in TRAIN_CHANNELS:
+            unconfirmed[on_air[1]] = on_air  # Replaces the train's previous command
+    else:
+        for train in [train for train, command in unconfirmed.items()
+                      if train_states.get(train, {}).get('command') == command[0]]:
+            del unconfirmed[train]
+        if not unconfirmed and (desired_message is None or on_air is desired_message):
+            return
+        rotation = list(unconfirmed.values())
+        if desired_message:
+            rotation.append(desired_message)
+        current = next((i for i, message in enumerate(rotation) if message is on_air), -1)
+        message = rotation[(current + 1) % len(rotation)]
+        if message is on_air:
+            return  # The only message to send is on air already
+        on_air = message
+    hub.ble.broadcast(on_air)
+    command_clock.reset()
+
+def service_fleet():
+    """One round of fleet supervision: read statuses, run dispatched plans and send queued commands"""
+    check_status_updates()
+    service_dispatcher()
+    service_command_queue()
+
+def idle(duration):
+    """Wait for duration ms while keeping the fleet serviced"""
+    timer = StopWatch()
+    while timer.time() < duration:
+        service_fleet()
+        wait(LOOP_INTERVAL)
+
+def read_line():
+    """
+    Collect whatever the operator has typed without blocking.
+    Returns the line once Enter is pressed, otherwise None.
+    """
+    while keyboard.poll(0):
+        char = stdin.read(1)
+        if char in ('\r', '\n'):
+            print()
+            line = ''.join(input_buffer)
+            input_buffer.clear()
+            return line
+        elif char in ('\x08', '\x7f'):
+            if input_buffer:
+                input_buffer.pop()
+                print('\x08 \x08', end='')
+        else:
+            input_buffer.append(char)
+            print(char, end='')  # Raw reads are not echoed
+    return None
+
+def prompt(message):
+    """Like input(), but the fleet is serviced while the operator types"""
+    print(message, end='')
+    while True:
+        service_fleet()
+        line = read_line()
+        if line is not None:
+            return line
+        wait(LOOP_INTERVAL)
 
 def merge_train_commands(commands_by_train, path):
     """Merge commands from multiple trains into a single ordered sequence"""
@@ -924,20 +1757,199 @@ def print_merged_commands(merged_commands):
             pattern_str = '-'.join(str(c).split('.')[-1] for c in cmd['pattern'])
             print(f"{cmd['number']}. {cmd['train']}: Move {cmd['action'].split('_')[0].lower()} until pattern {pattern_str}")
 
-def execute_multi_train_path(initial_positions, goals):
-    """Find and execute paths for multiple trains"""
+def block_segment(segment):
+    """Keep the planners off a segment that a train failed to get through"""
+    reservations[segment] = BLOCKED
+    reservations[(segment[1], segment[0])] = BLOCKED
+    log(LOG_WARN, f"Blocked segment {segment[0]}-{segment[1]}")
+
+def repair_route(merged_commands, index, repairers):
+    """
+    A train timed out on merged_commands[index]. Stop it, block the segment, send it back to
+    the city it came from and splice a repaired route for it into the remaining commands.
+    Returns True if the route could be repaired.
+    """
+    failed = merged_commands[index]
+    train = failed['train']
+    src, dst = failed['segment']
+    timer = StopWatch()
+    send_train_command(train, TRAIN_COMMAND["STOP"])
+    block_segment(failed['segment'])
+    if (dst, src) not in track or train not in repairers:
+        return False
+
+    # First try to go right away, staying off everything the other trains still need
+    # (including where they are now). Otherwise go once they are done, if they don't pass
+    # the city we back up to, staying off the cities where they end up.
+    remaining = merged_commands[index + 1:]
+    failed_segments = set(location for location, holder in reservations.items()
+                          if holder == BLOCKED and location in track)
+    busy_segments = set()
+    busy_cities = set()
+    final_cities = {}
+    for other, repairer in repairers.items():
+        if other != train:
+            busy_cities.add(repairer.start)
+            final_cities[other] = repairer.start
+    for cmd in remaining:
+        if cmd['train'] != train and 'segment' in cmd:
+            busy_segments.add(cmd['segment'])
+            busy_cities.update(cmd['segment'])
+            if 'arrives' in cmd:
+                final_cities[cmd['train']] = cmd['arrives']
+    for location, holder in reservations.items():
+        if holder in active_plans:  # Routes of dispatched trains
+            if location in track:
+                failed_segments.add(location)
+            else:
+                busy_cities.add(location)
+
+    repairer = repairers[train]
+    repairer.set_blocked(failed_segments | busy_segments, busy_cities - {src})
+    cities = repairer.route()
+    wait_for_others = False
+    if not cities and src not in busy_cities:
+        repairer.set_blocked(failed_segments, set(final_cities.values()))
+        cities = repairer.route()
+        wait_for_others = True
+    if not cities:
+        log(LOG_WARN, f"No repaired route for {train} from {src}")
+        return False
+    release_route(train)
+    reserve_route(train, {'cities': cities, 'segments': list(zip(cities, cities[1:])), 'segments_done': 0})
+
+    # Back up to where the train came from, then follow the repaired route. The train is on
+    # the return segment facing the other way, so arriving at src decides its orientation
+    # for the next segment the same way as in planned routes.
+    orientation = (ORIENTATION_BACKWARD if failed['action'] == "FORWARD_UNTIL_PATTERN"
+                   else ORIENTATION_FORWARD)
+    path = [TrackState({train: TrainState(Location(LOCATION_SEGMENT, (dst, src)), orientation)},
+                       switch_states.copy()),
+            TrackState({train: TrainState(Location(LOCATION_CITY, src))}, switch_states.copy())]
+    for city1, city2 in zip(cities, cities[1:]):
+        path.append(TrackState({train: TrainState(Location(LOCATION_SEGMENT, (city1, city2)))},
+                               track[(city1, city2)]["switches"]))
+        path.append(TrackState({train: TrainState(Location(LOCATION_CITY, city2))}, {}))
+    repaired = [dict(cmd, train=train) for cmd in process_path_for_reversals(path, train, repairer.goal)]
+    back, repaired = repaired[0], repaired[1:]
+
+    others = [cmd for cmd in remaining if cmd['train'] != train]
+    if wait_for_others:
+        merged_commands[index + 1:] = [back] + others + repaired
+    else:
+        merged_commands[index + 1:] = [back] + repaired + others
+    for number, cmd in enumerate(merged_commands, 1):
+        cmd['number'] = number
+    log(LOG_INFO, f"Repaired route for {train}: {' -> '.join(cities)} " +
+                  f"in {timer.time()} ms ({repairer.expansions} expansions so far)")
+    return True
+
+def run_route(merged_commands, repairers, confirm):
+    """
+    Carry out merged commands in order; repairs can replace the commands after the current one.
+    Returns True if every command was carried out.
+    """
+    index = 0
+    while index < len(merged_commands):
+        cmd = merged_commands[index]
+        index += 1
+        log(LOG_INFO, f"Executing command {cmd['number']}/{len(merged_commands)}")
+        
+        if cmd['type'] == 'switch':
+            # Set this and the following switch commands together
+            settings = [(cmd['switch'], cmd['position'])]
+            while index < len(merged_commands) and merged_commands[index]['type'] == 'switch':
+                settings.append((merged_commands[index]['switch'], merged_commands[index]['position']))
+                index += 1
+            failed = execute_switch_settings(settings)
+            if failed:
+                log(LOG_ERROR, f"{', '.join(failed)} didn't reach the desired positions!")
+                if not confirm or prompt("Continue anyway? (y/n): ").lower() != 'y':
+                    return False
+        
+        elif cmd['type'] == 'train':
+            pattern = cmd['pattern']
+            log(LOG_DEBUG, f"Looking for pattern: {'-'.join(str(c).split('.')[-1] for c in pattern)}")
+            number = send_train_command(cmd['train'], TRAIN_COMMAND[cmd['action']], pattern,
+                                        stall_seconds(cmd['train'], cmd))
+            move_timer = StopWatch()
+            timeout = move_timeout(cmd['train'], cmd)
+            if 'segment' in cmd:
+                preposition_switches(lookahead_switches(merged_commands, index, cmd['train'], cmd['segment']))
+            
+            # Wait for movement to complete
+            log(LOG_DEBUG, "Waiting for train to complete movement...")
+
+            movement_complete = False
+            stalled = False
+            while move_timer.time() < timeout:
+                service_fleet()
+                movement = move_result(cmd['train'], number, move_timer.time())
+                if movement == "STOPPED":
+                    log(LOG_INFO, "Movement completed!")
+                    record_move(cmd['train'], cmd, move_timer.time())
+                    idle(1000)  # Extra wait to ensure train is fully stopped
+                    movement_complete = True
+                    break
+                if movement == "STALLED":
+                    stalled = True
+                    break
+                wait(LOOP_INTERVAL)
+
+            if movement_complete and 'arrives' in cmd and cmd['train'] in repairers:
+                repairers[cmd['train']].move_to(cmd['arrives'])
+
+            if stalled:
+                log(LOG_WARN, f"{cmd['train']} stalled after {move_timer.time()} ms!")
+            elif not movement_complete:
+                log(LOG_WARN, f"Movement timed out after {timeout} ms!")
+            if not movement_complete:
+                segment_moves.pop(cmd['train'], None)
+                if 'segment' in cmd and repair_route(merged_commands, index - 1, repairers):
+                    continue
+                if not confirm or prompt("Continue anyway? (y/n): ").lower() != 'y':
+                    return False
+
+    return True
+
+def execute_multi_train_path(initial_positions, goals, confirm=True):
+    """
+    Find and execute paths for multiple trains.
+    Without confirm, the route runs without asking and stops at the first failure.
+    Returns True if every command was carried out.
+    The route is reserved while it runs, so the dispatcher plans around it.
+    """
+    global last_search_stats, dispatch_changed
     print(f"Planning routes for {len(goals)} trains...")
     for train, goal in goals.items():
         current = (initial_positions[train] if train in initial_positions 
                   else "unknown position")
         print(f"- {train}: {current} -> {goal}")
+
+    # Trains that stay put are only obstacles; the ones that move need a current state
+    stale = stale_trains([train for train, goal in goals.items()
+                          if initial_positions.get(train) != goal])
+    if stale:
+        print(f"Not planning: no recent status from {', '.join(stale)}")
+        return False
+    dispatched = [train for train in goals if train in active_plans]
+    if dispatched:
+        print(f"Not planning: {', '.join(dispatched)} already dispatched")
+        return False
+
+    # Trains parked by the dispatcher are obstacles
+    initial_positions = dict(initial_positions)
+    for train, city in train_positions.items():
+        if train not in initial_positions:
+            initial_positions[train] = city
     
     # Create initial state
     initial_state = TrackState(
         trains={
             train: TrainState(
                 Location(LOCATION_CITY, pos) if isinstance(pos, str)
-                else Location(LOCATION_SEGMENT, pos)
+                else Location(LOCATION_SEGMENT, pos),
+                start_orientation(train, pos)
             )
             for train, pos in initial_positions.items()
         },
@@ -945,11 +1957,12 @@ def execute_multi_train_path(initial_positions, goals):
     )
     
     # Find shortest paths ignoring orientation
-    path = find_paths(initial_state, goals)
+    path, last_search_stats = find_paths(initial_state, goals)
+    print(f"Search took {last_search_stats.total_ms} ms (type 'ps' for details)")
     
     if not path:
         print("No valid path found!")
-        return
+        return False
         
     # Process path for each train to determine reversals
     print("\nGenerating commands...")
@@ -963,48 +1976,303 @@ def execute_multi_train_path(initial_positions, goals):
     merged_commands = merge_train_commands(commands_by_train, path)
     print_merged_commands(merged_commands)
     
-    if input("\nExecute route? (y/n): ").lower() != 'y':
+    if confirm and prompt("\nExecute route? (y/n): ").lower() != 'y':
+        return False
+
+    # Searches kept per train so a timed-out move can be repaired without planning from scratch
+    repairers = {}
+    for train in commands_by_train:
+        start = initial_positions[train]
+        repairers[train] = RouteRepair(start if isinstance(start, str) else start[1], goals[train])
+
+    # The route is committed: keep the dispatcher off it until it's done
+    for train in goals:
+        routed_trains.add(train)
+        cities, segments = route_locations(path, train)
+        reserve_route(train, {'cities': cities, 'segments': segments, 'segments_done': 0})
+    try:
+        return run_route(merged_commands, repairers, confirm)
+    finally:
+        for train in goals:
+            release_route(train)
+            routed_trains.discard(train)
+        dispatch_changed = True  # Queued jobs may fit now
+
+def next_wave(pending, done):
+    """Jobs that can run now: dependencies finished and no earlier job of the same train pending"""
+    wave = []
+    busy = set()
+    for job in pending:
+        train = "TRAIN_" + job["train"]
+        if train not in busy and all(dep in done for dep in job.get("after", ())):
+            wave.append(job)
+        busy.add(train)
+    return wave
+
+def run_mission(name):
+    """Plan and execute all jobs of a mission back-to-back, reporting timing"""
+    mission = MISSIONS[name]
+    repeat = mission.get("repeat", 1)
+    positions = {}  # Last known city of every train in the mission
+    jobs_done = 0
+    mission_timer = StopWatch()
+
+    for round_number in range(1, repeat + 1):
+        print(f"\nMission {name}, round {round_number}/{repeat}")
+        round_timer = StopWatch()
+        pending = list(mission["jobs"])
+        done = set()
+
+        while pending:
+            wave = next_wave(pending, done)
+            if not wave:
+                print(f"Jobs {[job.get('id') for job in pending]} are waiting on each other!")
+                return False
+
+            initial_positions = {}
+            goals = {}
+            for job in wave:
+                train = "TRAIN_" + job["train"]
+                start = job.get("start", positions.get(train, located_position(train)))
+                if start is None:
+                    print(f"Don't know where {train} starts for job {job.get('id')}!")
+                    return False
+                initial_positions[train] = start
+                goals[train] = job["goal"]
+
+            # Parked trains stay where they are, so the planner routes around them
+            for train, city in positions.items():
+                if train not in goals:
+                    initial_positions[train] = city
+                    goals[train] = city
+
+            # Trains outside the mission (or not started yet) are obstacles held where they are
+            for train in TRAIN_CHANNELS:
+                if train not in initial_positions:
+                    position = train_positions.get(train, located_position(train))
+                    if position is not None:
+                        initial_positions[train] = position
+
+            wave_timer = StopWatch()
+            if not execute_multi_train_path(initial_positions, goals, confirm=False):
+                print(f"Mission {name} stopped after {jobs_done} jobs")
+                return False
+            print(f"Jobs {[job.get('id') for job in wave]} done in {wave_timer.time()} ms")
+
+            for job in wave:
+                positions["TRAIN_" + job["train"]] = job["goal"]
+                done.add(job.get("id"))
+                pending.remove(job)
+            jobs_done += len(wave)
+
+        print(f"Round {round_number}/{repeat} took {round_timer.time()} ms")
+
+    total_ms = mission_timer.time()
+    print(f"\nMission {name} complete: {jobs_done} jobs in {total_ms} ms " +
+          f"({total_ms // max(1, jobs_done)} ms per job)")
+    return True
+
+def add_dispatch_job(train, goal, start=None):
+    """Queue a job for the lifelong dispatcher"""
+    global dispatch_changed
+    if start:
+        if train in active_plans:
+            print(f"{train} is moving, leave out the start city")
+            return
+        train_positions[train] = start
+    elif train not in train_positions:
+        start = located_position(train, cities_only=True)
+        if not start:
+            print(f"Don't know where {train} is, give a start city")
+            return
+        train_positions[train] = start
+    dispatch_jobs.append((train, goal))
+    dispatch_changed = True
+    print(f"Queued {train} -> {goal} ({len(dispatch_jobs)} jobs waiting)")
+
+def route_locations(path, train):
+    """The cities and the segments a train passes along a planned path, in order"""
+    # The train's route alternates city, segment, city, ...
+    route = []
+    for state in path:
+        location = state.trains[train].location
+        if not route or route[-1] != location:
+            route.append(location)
+    return ([loc.value for loc in route if loc.type == LOCATION_CITY],
+            [loc.value for loc in route if loc.type == LOCATION_SEGMENT])
+
+def reserve_route(train, plan):
+    """Reserve the cities and segments the train still has to pass, and the switches they need"""
+    done = plan['segments_done']
+    for city in plan['cities'][done:]:
+        reservations[city] = train
+    for segment in plan['segments'][done:]:
+        reservations[segment] = train
+        reservations[(segment[1], segment[0])] = train
+        for switch, position in track[segment]["switches"].items():
+            switch_claims[switch] = (train, position)
+
+def release_route(train):
+    """Drop every reservation and switch claim held by the train"""
+    for location in [loc for loc, holder in reservations.items() if holder == train]:
+        del reservations[location]
+    for switch in [sw for sw, claim in switch_claims.items() if claim[0] == train]:
+        del switch_claims[switch]
+
+def plan_job(train, goal):
+    """
+    Plan a route for an idle train around the committed plans of the moving ones.
+    Returns True if the train got a plan.
+    """
+    global last_search_stats
+    # Parked trains are obstacles; moving trains are covered by their reservations
+    trains = {
+        name: TrainState(Location(LOCATION_CITY, city))
+        for name, city in train_positions.items()
+        if name not in active_plans
+    }
+    if stale_trains([train]):
+        log(LOG_DEBUG, f"Not planning {train} -> {goal}: its state is stale")
+        return False
+    if train in routed_trains:
+        return False  # Wait for the one-shot route moving it
+    path, last_search_stats = find_paths(TrackState(trains, switch_states.copy()), {train: goal})
+    if not path:
+        log(LOG_DEBUG, f"No route for {train} -> {goal} yet")
+        return False
+
+    cities, segments = route_locations(path, train)
+    plan = {
+        'goal': goal,
+        'commands': process_path_for_reversals(path, train, goal),
+        'step': 0,
+        'waiting': None,    # 'switch' or 'train' while a command is on its way
+        'version': 0,       # Desired switch version the current switch command waits for
+        'timeout': 0,       # ms the current command may take
+        'command': 0,       # Number of the train command the plan waits for
+        'timer': StopWatch(),
+        'cities': cities,
+        'segments': segments,
+        'segments_done': 0,
+        'moves_done': 0
+    }
+    active_plans[train] = plan
+    reserve_route(train, plan)
+    print(f"Dispatching {train}: {' -> '.join(plan['cities'])}")
+    return True
+
+def finish_plan(train, success):
+    """Take a train out of the dispatcher, parking it at its goal if it got there"""
+    global dispatch_changed
+    plan = active_plans.pop(train)
+    release_route(train)
+    if success:
+        train_positions[train] = plan['goal']
+        print(f"{train} reached {plan['goal']}")
+    else:
+        # Somewhere along the route; the operator has to tell us where
+        train_positions.pop(train, None)
+        send_train_command(train, TRAIN_COMMAND["STOP"])
+        print(f"{train} stopped, give a start city with its next job")
+    dispatch_changed = True
+
+def advance_plan(train, plan):
+    """Move a dispatched plan forward by at most one command, without blocking"""
+    global dispatch_changed
+    if plan['waiting'] == 'switch':
+        cmd = plan['commands'][plan['step']]
+        if switches_confirmed([(cmd['switch'], cmd['position'])], plan['version']):
+            plan['waiting'] = None
+            plan['step'] += 1
+        elif plan['timer'].time() > plan['timeout']:
+            log(LOG_ERROR, f"Failed to set {cmd['switch']} for {train}!")
+            finish_plan(train, False)
         return
-    
-    # Execute merged commands in order
-    for cmd in merged_commands:
-        print(f"\nExecuting command {cmd['number']}/{len(merged_commands)}")
-        
-        if cmd['type'] == 'switch':
-            if not execute_switch_command(cmd['switch'], cmd['position']):
-                print(f"Failed to set {cmd['switch']} after all retries!")
-                if input("Continue anyway? (y/n): ").lower() != 'y':
-                    return
-        
-        elif cmd['type'] == 'train':
-            pattern = cmd['pattern']
-            print(f"Looking for pattern: {'-'.join(str(c).split('.')[-1] for c in pattern)}")
-            send_train_command(cmd['train'], TRAIN_COMMAND[cmd['action']], pattern)
-            
-            # Wait for movement to complete
-            print("Waiting for train to complete movement...")
-            wait(1000)  # Initial wait to let train start moving
 
-            timeout = 30000  # 30 second timeout
-            interval = 100   # Check every 100ms
-            elapsed = 0
+    if plan['waiting'] == 'train':
+        movement = move_result(train, plan['command'], plan['timer'].time())
+        if movement == "STOPPED":
+            record_move(train, plan['commands'][plan['step']], plan['timer'].time())
+            plan['waiting'] = None
+            plan['step'] += 1
+            plan['moves_done'] += 1
+            # Every segment takes two moves: onto the segment, then into the next city
+            if plan['moves_done'] % 2 == 0:
+                plan['segments_done'] += 1
+                release_route(train)
+                reserve_route(train, plan)
+                dispatch_changed = True
+        elif movement == "STALLED" or plan['timer'].time() > plan['timeout']:
+            if movement == "STALLED":
+                log(LOG_ERROR, f"{train} stalled after {plan['timer'].time()} ms!")
+            else:
+                log(LOG_ERROR, f"{train} movement timed out after {plan['timeout']} ms!")
+            cmd = plan['commands'][plan['step']]
+            segment_moves.pop(train, None)
+            finish_plan(train, False)
+            if 'segment' in cmd:
+                block_segment(cmd['segment'])
+        return
 
-            movement_complete = False
-            while elapsed < timeout:
-                check_status_updates()
-                if (cmd['train'] in train_states and 
-                    train_states[cmd['train']]["movement"] == "STOPPED"):
-                    print("Movement completed!")
-                    wait(1000)  # Extra wait to ensure train is fully stopped
-                    movement_complete = True
-                    break
-                wait(interval)
-                elapsed += interval
+    if plan['step'] >= len(plan['commands']):
+        finish_plan(train, True)
+        return
 
-            if not movement_complete:
-                print("Warning: Movement timed out after 30 seconds!")
-                if input("Continue anyway? (y/n): ").lower() != 'y':
-                    return
+    cmd = plan['commands'][plan['step']]
+    if cmd['type'] == 'switch':
+        plan['version'] = set_desired([(cmd['switch'], cmd['position'])])
+        if switches_confirmed([(cmd['switch'], cmd['position'])], plan['version']):
+            plan['step'] += 1  # Already confirmed in place
+        else:
+            plan['waiting'] = 'switch'
+            plan['timeout'] = switch_timeout([(cmd['switch'], cmd['position'])])
+            plan['timer'].reset()
+    elif cmd['type'] == 'train':
+        plan['command'] = send_train_command(train, TRAIN_COMMAND[cmd['action']], cmd['pattern'],
+                                             stall_seconds(train, cmd))
+        # Other trains' routes are covered by their switch claims
+        ahead = lookahead_switches(plan['commands'], plan['step'] + 1, train, cmd['segment'])
+        preposition_switches([(switch, position) for switch, position in ahead
+                              if switch_claims.get(switch, (train,))[0] == train])
+        plan['waiting'] = 'train'
+        plan['timeout'] = move_timeout(train, cmd)
+        plan['timer'].reset()
+    else:  # Reversals are already part of the next move's direction
+        plan['step'] += 1
+
+def service_dispatcher():
+    """Run the dispatched plans and hand queued jobs to idle trains"""
+    global dispatch_changed
+    for train, plan in list(active_plans.items()):
+        advance_plan(train, plan)
+
+    # Only plan again when something changed that could unblock a job
+    if not dispatch_changed:
+        return
+    dispatch_changed = False
+    seen = set()
+    for job in list(dispatch_jobs):
+        train, goal = job
+        if train in active_plans or train in seen:
+            seen.add(train)  # Jobs of one train run in the order they were queued
+            continue
+        seen.add(train)
+        if plan_job(train, goal):
+            dispatch_jobs.remove(job)
+
+def show_dispatcher():
+    """Print queued jobs and the progress of dispatched trains"""
+    print("\nDispatched trains:")
+    if not active_plans:
+        print("None")
+    for train, plan in active_plans.items():
+        print(f"{train}: {' -> '.join(plan['cities'])}, " +
+              f"command {plan['step'] + 1}/{len(plan['commands'])}")
+    print("Queued jobs:")
+    if not dispatch_jobs:
+        print("None")
+    for train, goal in dispatch_jobs:
+        print(f"{train} -> {goal}")
 
 ###########################################
 # 6. INITIALIZATION AND MAIN LOOP
@@ -1024,12 +2292,48 @@ hub = InventorHub(broadcast_channel=COMMAND_CHANNEL,
 switch_states = {}
 train_states = {}
 command_number = 0
-processed_statuses = set()
+last_status = {}          # Status channel -> number of the last status processed
+fleet_clock = StopWatch()
+fleet = {                 # Status channel -> when its hub was last heard and how often it reports
+    channel: {'heard': None, 'count': 0, 'rate': 0, 'window': 0, 'fresh': False}
+    for channel in STATUS_HANDLERS
+}
+last_search_stats = None  # SearchStats from the most recent find_paths
+outgoing_commands = []    # Commands waiting for their turn on air
+command_clock = StopWatch()
+on_air = None             # Message currently broadcast
+unconfirmed = {}          # Train -> its last command, repeated until the train's status confirms it
+desired_switches = {}     # Switch -> position the switch hubs should converge to
+desired_version = 0       # Bumped whenever desired_switches changes
+desired_message = None    # desired_switches as a DESIRED message
+switch_versions = {}      # Switch -> desired version its hub reported last
+switch_move_times = {}    # Switch status channel -> ms the hub's last move took
+switch_timings = {}       # Switch status channel -> (average, deviation) of its move times in ms
+switch_channels = {}      # Switch -> status channel of the hub it's attached to
+travel_times = {}         # (train, segment) -> (average, deviation) of the ms the train takes for it
+travel_pace = 0           # Average ms per distance unit over travel_times
+marker_gaps = {}          # (train, segment) -> (average, deviation) of the longest ms between markers on its moves
+segment_moves = {}        # Train -> (segment, ms) of its move onto a segment, until it arrives
+input_buffer = []         # Characters typed so far on the current line
+
+# Lifelong dispatcher
+dispatch_jobs = []        # (train, goal) jobs waiting for their train
+active_plans = {}         # Train -> plan being executed by the dispatcher
+routed_trains = set()     # Trains moved by a one-shot route, which the dispatcher leaves alone
+train_positions = {}      # City of every train the dispatcher knows about, while parked
+reservations = {}         # City or segment -> train whose committed plan needs it
+switch_claims = {}        # Switch -> (train, position) needed by a committed plan
+dispatch_changed = False  # Set when a job could have become plannable
+
+# Non-blocking operator input
+keyboard = poll()
+keyboard.register(stdin)
 
 # Precompute distances
 print("Precomputing shortest path distances...")
 all_distances = compute_all_distances()
 print("Distance computation complete!")
+load_travel_times()
 
 # Validate track definition
 print("Validating track layout...")
@@ -1040,6 +2344,9 @@ for segment, info in track.items():
         validation_errors.append(f"Missing approach pattern for segment {segment}")
     if "at_city" not in info["patterns"]:
         validation_errors.append(f"Missing at_city pattern for segment {segment}")
+    # Single-color patterns may be written without the tuple
+    for kind, pattern in info["patterns"].items():
+        info["patterns"][kind] = as_pattern(pattern)
 
 if validation_errors:
     print("Track validation errors:")
@@ -1049,15 +2356,36 @@ if validation_errors:
 else:
     print("Track layout valid!")
 
+# Index the marker patterns for locating trains from their statuses,
+# and check that every pattern stops trains at one place only
+pattern_index = build_pattern_index()
+pattern_problems, stop_patterns = analyze_patterns()
+if pattern_problems:
+    print("Patterns that can stop trains at the wrong place:")
+    for problem in pattern_problems:
+        print(f"- {problem}")
+if SHORTEN_PATTERNS:
+    shortened = sum(1 for (segment, kind), pattern in stop_patterns.items()
+                    if len(pattern) < len(as_pattern(track[segment]["patterns"][kind])))
+    print(f"{shortened} of {len(stop_patterns)} stop patterns shortened to their unambiguous end")
+
 # Main command loop
 print("\nLeader hub ready!")
 print("Commands:")
 print("Multi-train pathfinding:")
 print("  m - Start multi-train movement")
+print("  b                    - List batch missions")
+print("  b shuttle            - Run mission SHUTTLE without prompts")
+print("Lifelong dispatcher:")
+print("  d csx la nyc         - Queue a job: CSX from LA to NYC, runs as soon as possible")
+print("  d csx atlanta        - Queue a job from wherever CSX ends up")
+print("  dq                   - Show dispatched trains and queued jobs")
+print("  ub                   - Unblock segments that trains failed to get through")
 print("Switches:")
 print("  s a 0 - Set switch A to straight")
 print("  s a 1 - Set switch A to diverging")
 print("  (same for switches B-J)")
+print("  cal   - Calibrate the L motor switches (B, E, G, I)")
 print("Single train commands:")
 print("  t csx f red-yellow    - Move CSX train forward until RED-YELLOW pattern")
 print("  t csx b yellow-green  - Move CSX train backward until YELLOW-GREEN pattern")
@@ -1065,22 +2393,25 @@ print("  t csx s              - Stop CSX train")
 print("  (same for up and cn)")
 print("Status:")
 print("  st                   - Show all device status")
+print("  ps                   - Show planner stats for the last search")
+print("  log                  - Show recent log messages, including debug")
 print("  q                    - Quit")
 
 def show_status():
-    """Display current status of all devices"""
-    # Poll for updates
-    for _ in range(10):
-        check_status_updates()
-        wait(50)
-        
+    """Display the current status of all devices, as last heard by the event loop"""
     print("\nSwitch positions:")
     if not switch_states:
         print("No switches reporting")
     else:
         for switch_name in sorted(switch_states.keys()):
             position = switch_states[switch_name]
-            print(f"{switch_name}: {'DIVERGING' if position else 'STRAIGHT'}")
+            status = f"{switch_name}: {'DIVERGING' if position else 'STRAIGHT'}"
+            if desired_switches.get(switch_name, position) != position:
+                status += f", moving to {'DIVERGING' if desired_switches[switch_name] else 'STRAIGHT'}"
+            print(status + f" (v{switch_versions.get(switch_name, 0)}/{desired_version})")
+        for channel in sorted(switch_move_times):
+            print(f"Hub {channel - SWITCH_STATUS_1 + 1} last move took {switch_move_times[channel]} ms, " +
+                  f"timeout {timing_limit(switch_timings.get(channel), SWITCH_SLACK, SWITCH_TIMEOUT)} ms")
     
     print("\nTrain status:")
     if not train_states:
@@ -1089,25 +2420,85 @@ def show_status():
         for train_name in sorted(train_states.keys()):
             state = train_states[train_name]
             status = f"{train_name}: {state['movement']}, sees {state['color']}"
-            if 'target_pattern' in state:
-                pattern_str = '-'.join(str(c).split('.')[-1] for c in state['target_pattern'])
-                status += f", seeking {pattern_str}"
+            if 'location' in state:
+                status += f", at {state['location'].value} ({state['orientation'].lower()})"
+            elif state['movement'] == "STOPPED":
+                status += f", position unknown (markers {state['history'][1:] or 'none'})"
+            if state['battery']:
+                status += f", battery {state['battery'] / 1000:.1f} V"
+                if state['battery'] < BATTERY_LOW:
+                    status += " (LOW)"
             print(status)
 
+    print("\nHubs:")
+    now = fleet_clock.time()
+    for channel in sorted(fleet):
+        device = fleet[channel]
+        if device['heard'] is None:
+            print(f"{device_name(channel)}: never heard")
+            continue
+        state = "ok" if device['fresh'] else "STALE"
+        print(f"{device_name(channel)}: {state}, heard {now - device['heard']} ms ago, " +
+              f"{device['rate']} statuses/min")
+
+    print("\nLearned travel times:")
+    if not travel_times:
+        print("None yet, planning by distance")
+    for (train, segment), timing in sorted(travel_times.items()):
+        print(f"{train}: {segment[0]} -> {segment[1]} in {timing[0]} ms +/- {timing[1]} ms, " +
+              f"timeout {timing_limit(timing, MOVEMENT_SLACK, MOVEMENT_TIMEOUT)} ms")
+
 while True:
-    cmd = input("Enter command: ").strip().lower()
+    cmd = prompt("Enter command: ").strip().lower()
     
     if cmd == 'q':
         print("Quitting...")
         break
     elif cmd in ['st', 'status']:
         show_status()
+    elif cmd == 'log':
+        dump_log()
+    elif cmd == 'b':
+        for name, mission in MISSIONS.items():
+            print(f"{name}: {len(mission['jobs'])} jobs, repeated {mission.get('repeat', 1)}x")
+    elif cmd.startswith('b '):
+        name = cmd[2:].strip()
+        if name in MISSIONS:
+            run_mission(name)
+        else:
+            print(f"Unknown mission. Missions: {', '.join(MISSIONS)}")
+    elif cmd.startswith('d '):
+        parts = cmd.upper().split()
+        if len(parts) in [3, 4]:
+            train_name = "TRAIN_" + parts[1]
+            start = parts[2] if len(parts) == 4 else None
+            goal = parts[-1]
+            if any(city not in city_connectivity for city in parts[2:]):
+                print("Unknown city")
+            else:
+                add_dispatch_job(train_name, goal, start)
+        else:
+            print("Invalid dispatch command. Use: d train [start] goal")
+    elif cmd == 'dq':
+        show_dispatcher()
+    elif cmd == 'ub':
+        for location in [loc for loc, holder in reservations.items() if holder == BLOCKED]:
+            del reservations[location]
+        print("All segments unblocked")
+    elif cmd == 'ps':
+        if last_search_stats:
+            last_search_stats.show()
+        else:
+            print("No search has run yet")
+    elif cmd == 'cal':
+        send_calibrate()
     elif cmd.startswith('s ') and len(cmd) == 5:
         # Switch commands: s a 0
         switch = f"SWITCH_{cmd[2].upper()}"
-        position = int(cmd[4])
-        if position in [0, 1]:
-            send_switch_command(switch, position)
+        if switch not in layout_switches():
+            print("Invalid switch. Use: " + ", ".join(sorted(name[-1].lower() for name in layout_switches())))
+        elif cmd[4] in "01":
+            set_desired([(switch, int(cmd[4]))])
         else:
             print("Invalid switch position")
     elif cmd.startswith('t '):
@@ -1166,7 +2557,7 @@ while True:
         goals = {}
         
         while True:
-            train = input("\nTrain name (CSX/UP/CN/BNSF/NS/METRO or blank to finish): ").strip().upper()
+            train = prompt("\nTrain name (CSX/UP/CN/BNSF/NS/METRO or blank to finish): ").strip().upper()
             if not train:
                 break
                 
@@ -1175,14 +2566,20 @@ while True:
                 continue
                 
             train = "TRAIN_" + train
-            pos = input("Current position: ").strip().upper()
-            if ',' in pos:
+            located = located_position(train)
+            if located:
+                pos = prompt(f"Current position (blank for {located}): ").strip().upper()
+            else:
+                pos = prompt("Current position: ").strip().upper()
+            if not pos and located:
+                initial_positions[train] = located
+            elif ',' in pos:
                 city1, city2 = pos.split(',')
                 initial_positions[train] = (city1.strip(), city2.strip())
             else:
                 initial_positions[train] = pos
                 
-            goal = input("Goal city: ").strip().upper()
+            goal = prompt("Goal city: ").strip().upper()
             goals[train] = goal
         
         if initial_positions and goals:
@@ -1191,5 +2588,3 @@ while True:
             print("No trains specified!")
     else:
         print("Invalid command")
-    
-    wait(50)  # Short delay to prevent busy loop
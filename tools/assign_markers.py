@@ -0,0 +1,259 @@
+# Marker pattern assignment
+# - picks the approach and at_city color patterns for every segment of a
+#   leader's layout from the four colors the train sensors read reliably
+# - gives every side of a city one set of at_city markers: trains arriving
+#   from the other side read the same markers backwards
+# - keeps patterns as short as possible, so trains need fewer markers and
+#   detect their stops sooner
+# - checks every candidate with the pattern analyzer from the leader script,
+#   so no pattern also occurs in the markers a train passes on its way there
+# - makes sure a train that reached a city can be located from the approach
+#   and at_city markers it passed (see locate_train in the leader)
+# - prints the layout as a `track` dict to paste into the leader script
+#
+# Usage (from the repo root, needs `pip install pybricks` for the API definitions):
+#   python tools/assign_markers.py 09c                   # print the new track dict
+#   python tools/assign_markers.py 09c --tries 200       # try more orders for shorter patterns
+#   python tools/assign_markers.py 08 -o new_track.py    # write it to a file
+#
+# The sides of each city come from the layout's current at_city patterns.
+# Marker sets and approaches are filled in greedily: the ones around the
+# busiest cities first, each with the shortest pattern that still passes the
+# checks. Every try shuffles the order of equally busy ones and the result
+# with the fewest physical markers is kept.
+
+import argparse
+import itertools
+import random
+import sys
+from pathlib import Path
+
+from scenario_loader import LEADERS, load_leader, use_layout
+
+PATTERN_COLORS = ("RED", "YELLOW", "GREEN", "BLUE")
+MIN_LENGTH = 2  # The leader doesn't shorten patterns below two markers either
+MAX_LENGTH = 6
+
+###########################################
+# 1. CANDIDATE PATTERNS
+###########################################
+
+def candidates(length):
+    """Patterns of the given length without the same color twice in a row (trains can't tell those apart)"""
+    for colors in itertools.product(PATTERN_COLORS, repeat=length):
+        if all(a != b for a, b in zip(colors, colors[1:])):
+            yield colors
+
+CANDIDATES = {length: list(candidates(length)) for length in range(MIN_LENGTH, MAX_LENGTH + 1)}
+
+# Trains arriving from the other side read at_city markers backwards, so those can't read the same both ways
+AT_CITY_CANDIDATES = {length: [colors for colors in patterns if colors != colors[::-1]]
+                      for length, patterns in CANDIDATES.items()}
+
+def marker_sets(leader, track):
+    """
+    The at_city markers of the layout, from its current patterns: (city, key) -> [(segment, backwards)].
+    Arrivals whose patterns are the same or reversed read the same markers, from the same
+    or the other side. Arrivals with a pattern that reads the same both ways (like a single
+    color) can't show their side, so that comes from reverse_for instead: a train that goes
+    on from one arrival to the other segment without reversing passes through the city.
+    """
+    pattern_key = leader["pattern_key"]
+    sets = {}
+    for segment, info in track.items():
+        key = pattern_key(info["patterns"]["at_city"])
+        members = sets.setdefault((segment[1], min(key, key[::-1])), [])
+        if key != key[::-1]:
+            members.append((segment, key != min(key, key[::-1])))
+        elif not members:
+            members.append((segment, False))
+        else:
+            first, first_backwards = members[0]
+            through = segment[0] not in track[first]["reverse_for"]
+            members.append((segment, first_backwards != through))
+    return sets
+
+def assignment_order(track, sets, rng):
+    """
+    All ("at_city", set) and ("approach", segment) to assign, most crowded first: markers
+    around a city that many segments end at have the most neighbors to stay apart from
+    """
+    ending_at = {}
+    for city1, city2 in track:
+        ending_at[city2] = ending_at.get(city2, 0) + 1
+    items = [("at_city", marker_set) for marker_set in sets] + [("approach", segment) for segment in track]
+    rng.shuffle(items)
+    return sorted(items, key=lambda item: -ending_at[item[1][0] if item[0] == "at_city" else item[1][1]])
+
+###########################################
+# 2. ASSIGNMENT
+###########################################
+
+def to_colors(leader, names):
+    return tuple(getattr(leader["Color"], name) for name in names)
+
+def runs_together(approach, at_city):
+    """True if the approach ends with the color the at_city markers start with (trains can't tell those apart)"""
+    return bool(approach and at_city and approach[-1] == at_city[0])
+
+def sharing_track(track, segment):
+    """The other segments that end or start at a city of segment, so their markers lie near the same track"""
+    return [other for other in track if other != segment and set(other) & set(segment)]
+
+def checks_pass(leader, track):
+    """True if the patterns assigned so far stop trains in the right places and locate them"""
+    problems, _ = leader["analyze_patterns"]()
+    return not problems and locatable(leader, track)
+
+def fits_at_city(leader, track, members, names):
+    """True if the marker set can go on its city, read backwards by the arrivals from the other side"""
+    colors = to_colors(leader, names)
+    for segment, backwards in members:
+        at_city = colors[::-1] if backwards else colors
+        if runs_together(track[segment]["patterns"]["approach"], at_city):
+            break
+        track[segment]["patterns"]["at_city"] = at_city
+    else:
+        if checks_pass(leader, track):
+            return True
+    for segment, backwards in members:
+        track[segment]["patterns"]["at_city"] = ()
+    return False
+
+def fits_approach(leader, track, segment, names):
+    """True if the approach can go on the segment next to the patterns assigned so far"""
+    patterns = track[segment]["patterns"]
+    approach = to_colors(leader, names)
+    if runs_together(approach, patterns["at_city"]):
+        return False
+    # A train that knows only the approach it passed still has to tell these segments apart
+    if any(track[other]["patterns"]["approach"] == approach for other in sharing_track(track, segment)):
+        return False
+    patterns["approach"] = approach
+    if not checks_pass(leader, track):
+        patterns["approach"] = ()
+        return False
+    return True
+
+def locatable(leader, track):
+    """True if approach followed by at_city tells every city apart, for the segments done so far"""
+    index = leader["build_pattern_index"]()
+    pattern_key = leader["pattern_key"]
+    for info in track.values():
+        approach, at_city = info["patterns"]["approach"], info["patterns"]["at_city"]
+        if approach and at_city and len(index[pattern_key(approach) + pattern_key(at_city)]) > 1:
+            return False
+    return True
+
+def assign_once(leader, city_connectivity, base_track, sets, rng):
+    """One greedy pass. Returns the track with patterns, or None if something had no pattern left."""
+    track = {segment: dict(info, patterns={"approach": (), "at_city": ()})
+             for segment, info in base_track.items()}
+    use_layout(leader, city_connectivity, track)
+    for kind, item in assignment_order(track, sets, rng):
+        for length in range(MIN_LENGTH, MAX_LENGTH + 1):
+            if kind == "at_city":
+                found = any(fits_at_city(leader, track, sets[item], names) for names in AT_CITY_CANDIDATES[length])
+            else:
+                found = any(fits_approach(leader, track, item, names) for names in CANDIDATES[length])
+            if found:
+                break
+        else:
+            return None
+    return track
+
+def total_markers(leader, track, sets):
+    """Markers to put on the layout: each city's at_city set once, and every approach"""
+    as_pattern = leader["as_pattern"]
+    at_city = sum(len(as_pattern(track[members[0][0]]["patterns"]["at_city"])) for members in sets.values())
+    return at_city + sum(len(as_pattern(info["patterns"]["approach"])) for info in track.values())
+
+def assign(leader, tries, seed):
+    """Best of several greedy passes over the leader's layout"""
+    city_connectivity, base_track = leader["city_connectivity"], leader["track"]
+    sets = marker_sets(leader, base_track)
+    rng = random.Random(seed)
+    best = None
+    for _ in range(tries):
+        track = assign_once(leader, city_connectivity, base_track, sets, rng)
+        if track and (best is None or total_markers(leader, track, sets) < total_markers(leader, best, sets)):
+            best = track
+    if best:
+        use_layout(leader, city_connectivity, best)  # Leave the leader with the result
+    return best
+
+###########################################
+# 3. OUTPUT
+###########################################
+
+def city_label(city):
+    """LAS_VEGAS -> Las Vegas, but short names like NYC stay as they are"""
+    if len(city) <= 3:
+        return city
+    return city.replace("_", " ").title()
+
+def color_names(leader, pattern):
+    names = {getattr(leader["Color"], name): name for name in PATTERN_COLORS}
+    return ", ".join(f"Color.{names[color]}" for color in pattern)
+
+def format_track(leader, track):
+    """The track as it's written in the leader scripts"""
+    positions = {value: name for name, value in leader["SWITCH_POSITION"].items()}
+    lines = ["track = {"]
+    segments = list(track)
+    for i, segment in enumerate(segments):
+        info = track[segment]
+        lines.append(f"    {segment!r}: {{".replace("'", '"'))
+        if info["switches"]:
+            lines.append('        "switches": {')
+            switches = list(info["switches"].items())
+            for j, (switch, position) in enumerate(switches):
+                comma = "," if j < len(switches) - 1 else ""
+                lines.append(f'            "{switch}": SWITCH_POSITION["{positions[position]}"]{comma}')
+            lines.append("        },")
+        else:
+            lines.append('        "switches": {},')
+        lines.append(f'        "patterns": {{  # Patterns near {city_label(segment[1])}')
+        lines.append(f'            "approach": ({color_names(leader, info["patterns"]["approach"])}),')
+        lines.append(f'            "at_city": ({color_names(leader, info["patterns"]["at_city"])})')
+        lines.append("        },")
+        lines.append(f'        "distance": {info["distance"]},')
+        reverse_for = ", ".join(f'"{city}"' for city in info["reverse_for"])
+        lines.append(f'        "reverse_for": [{reverse_for}]')
+        lines.append("    }," if i < len(segments) - 1 else "    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(description="Assign unambiguous marker patterns to a leader's layout")
+    parser.add_argument("scenario", choices=sorted(LEADERS), help="leader whose layout gets new patterns")
+    parser.add_argument("--tries", type=int, default=20, help="greedy passes in different orders (default 20)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the order of the passes")
+    parser.add_argument("-o", "--output", type=Path, help="write the track dict to this file instead of printing it")
+    args = parser.parse_args()
+
+    leader = load_leader(args.scenario)
+    if "analyze_patterns" not in leader:
+        print(f"Leader {args.scenario} has no pattern analyzer")
+        return 1
+    sets = marker_sets(leader, leader["track"])
+    before = total_markers(leader, leader["track"], sets)
+
+    track = assign(leader, args.tries, args.seed)
+    if track is None:
+        print(f"No assignment found with patterns of up to {MAX_LENGTH} markers")
+        return 1
+
+    problems, stop_patterns = leader["analyze_patterns"]()
+    summary = (f"# {len(stop_patterns)} patterns with {total_markers(leader, track, sets)} markers " +
+               f"(was {before}), {len(problems)} ambiguous\n")
+    text = summary + format_track(leader, track)
+    if args.output:
+        args.output.write_text(text)
+        print(summary.strip("# \n") + f", written to {args.output}")
+    else:
+        print(text, end="")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+# Planner benchmark suite
+# - runs the planners from the leader scripts on a computer:
+#    - breadth-first search from scenario 06 (one train)
+#    - Dijkstra's algorithm from scenario 07 (one train)
+#    - A* from scenarios 08 and 09c (one or more trains)
+# - on the shipped six-city (08) and nine-city (09c) layouts, and on generated
+#   layouts of 10-200 cities with 1-12 trains
+# - records wall time, states explored, peak memory and plan cost for each run,
+#   and compares the results with a stored baseline to catch regressions
+#
+# Usage (from the repo root, needs `pip install pybricks` for the API definitions):
+#   python tools/benchmark_planners.py                  # run and compare with the baseline
+#   python tools/benchmark_planners.py --quick          # smaller grid, for a fast check
+#   python tools/benchmark_planners.py --save-baseline  # run and store the results as the new baseline
+#
+# Peak memory is measured with tracemalloc on the computer, so it shows how
+# memory grows with layout size, not how many bytes the hub will use.
+
+import argparse
+import json
+import math
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from scenario_loader import load_leader, use_layout
+
+BASELINE_FILE = Path(__file__).resolve().parent / "benchmark_baseline.json"
+
+GENERATED_CITY_COUNTS = [10, 25, 50, 100, 200]
+QUICK_CITY_COUNTS = [10, 25, 50]
+TRAIN_COUNTS = [1, 2, 4, 8, 12]
+QUICK_TRAIN_COUNTS = [1, 2, 4]
+
+TIME_TOLERANCE = 0.5   # Flag runs more than 50% slower than the baseline...
+TIME_SLACK_MS = 1.0    # ...but ignore differences below timer noise
+
+###########################################
+# 1. LAYOUTS
+###########################################
+
+def shipped_layout(scenario):
+    """Layout as defined in a leader script"""
+    leader = load_leader(scenario)
+    return leader["city_connectivity"], leader["track"]
+
+def generate_layout(num_cities, seed):
+    """
+    Generate a connected layout in the same format as the leader scripts.
+    Cities are random points; each one is linked to its nearest neighbors and
+    the pieces are then joined up so that every city can be reached.
+    """
+    rng = random.Random(seed)
+    cities = ["C{0:03d}".format(i) for i in range(num_cities)]
+    points = {city: (rng.random(), rng.random()) for city in cities}
+
+    def dist(a, b):
+        (xa, ya), (xb, yb) = points[a], points[b]
+        return math.hypot(xa - xb, ya - yb)
+
+    edges = set()
+    for city in cities:
+        nearest = sorted((c for c in cities if c != city), key=lambda c: dist(city, c))
+        for other in nearest[:2]:
+            edges.add(tuple(sorted((city, other))))
+
+    # Join components by their closest pair of cities until everything is connected
+    while True:
+        component = {cities[0]}
+        frontier = [cities[0]]
+        while frontier:
+            city = frontier.pop()
+            for a, b in edges:
+                for here, there in ((a, b), (b, a)):
+                    if here == city and there not in component:
+                        component.add(there)
+                        frontier.append(there)
+        if len(component) == num_cities:
+            break
+        outside = [c for c in cities if c not in component]
+        a, b = min(((a, b) for a in component for b in outside), key=lambda e: dist(*e))
+        edges.add(tuple(sorted((a, b))))
+
+    city_connectivity = {city: [] for city in cities}
+    for a, b in sorted(edges):
+        city_connectivity[a].append(b)
+        city_connectivity[b].append(a)
+
+    # Scale distances so a typical segment is about as long as on the real layout
+    scale = 150 / statistics.median(dist(a, b) for a, b in edges)
+
+    # Each city has two sides; going on to a city on the side you came from needs a reversal
+    sides = {city: {n: rng.randint(0, 1) for n in city_connectivity[city]} for city in cities}
+
+    def switches_for(city, neighbor):
+        # A ladder of switches at each city: leave through the i-th exit by
+        # setting switch i to DIVERGING and the ones before it to STRAIGHT
+        exits = city_connectivity[city]
+        index = exits.index(neighbor)
+        switches = {}
+        for i in range(min(index + 1, len(exits) - 1)):
+            switches["SWITCH_{0}_{1}".format(city, i)] = 1 if i == index else 0
+        return switches
+
+    track = {}
+    for a, b in sorted(edges):
+        distance = max(40, min(330, round(dist(a, b) * scale)))
+        for src, dst in ((a, b), (b, a)):
+            track[(src, dst)] = {
+                "switches": switches_for(src, dst),
+                "patterns": {"approach": (), "at_city": ()},
+                "distance": distance,
+                "reverse_for": [n for n in city_connectivity[dst]
+                                if sides[dst][n] == sides[dst][src]]
+            }
+    return city_connectivity, track
+
+def pick_missions(city_connectivity, num_trains, seed):
+    """Distinct start and goal cities for each train"""
+    rng = random.Random(seed)
+    cities = sorted(city_connectivity)
+    starts = rng.sample(cities, num_trains)
+    goals = rng.sample(cities, num_trains)
+    # Don't hand out trivial missions where a train is already at its goal
+    for i in range(num_trains):
+        if starts[i] == goals[i]:
+            j = (i + 1) % num_trains
+            goals[i], goals[j] = goals[j], goals[i]
+    trains = ["TRAIN_{0}".format(i + 1) for i in range(num_trains)]
+    return dict(zip(trains, starts)), dict(zip(trains, goals))
+
+###########################################
+# 2. PLANNERS
+###########################################
+
+class CountingTrack(dict):
+    """Track dict that counts full scans; BFS scans the track once per city it expands"""
+    scans = 0
+
+    def items(self):
+        self.scans += 1
+        return super().items()
+
+def counting_queue(queue_class):
+    """Priority queue subclass that counts pops, i.e. states explored (A* reports this itself)"""
+    class CountingQueue(queue_class):
+        pops = 0
+
+        def pop(self):
+            CountingQueue.pops += 1
+            return super().pop()
+    return CountingQueue
+
+def path_cost(track, path):
+    return sum(track[segment]["distance"] for segment in path)
+
+def run_bfs(leader, starts, goals, max_states):
+    original = leader["track"]
+    track = CountingTrack(original)
+    leader["track"] = track
+    try:
+        (train, start), = starts.items()
+        path = leader["find_path"](start, goals[train])
+    finally:
+        leader["track"] = original
+    solved = bool(path)
+    return solved, track.scans, path_cost(track, path) if solved else None
+
+def run_dijkstra(leader, starts, goals, max_states):
+    queue_class = leader["PriorityQueue"]
+    leader["PriorityQueue"] = counting_queue(queue_class)
+    try:
+        (train, start), = starts.items()
+        path = leader["find_path"](start, goals[train])
+        states = leader["PriorityQueue"].pops
+    finally:
+        leader["PriorityQueue"] = queue_class
+    solved = bool(path)
+    return solved, states, path_cost(leader["track"], path) if solved else None
+
+def run_astar(leader, starts, goals, max_states):
+    Location, TrainState, TrackState = leader["Location"], leader["TrainState"], leader["TrackState"]
+    initial_state = TrackState(
+        trains={train: TrainState(Location(leader["LOCATION_CITY"], city))
+                for train, city in starts.items()},
+        switches={}
+    )
+
+    path, stats = leader["find_paths"](initial_state, goals, max_depth=max_states)
+    states = stats.nodes_expanded
+
+    if not path:
+        return False, states, None
+
+    # Cost is the total length of the segments the trains drive onto
+    cost = 0
+    for current, following in zip(path, path[1:]):
+        for train, train_state in following.trains.items():
+            location = train_state.location
+            if (location.type == leader["LOCATION_SEGMENT"] and
+                    current.trains[train].location != location):
+                cost += leader["track"][location.value]["distance"]
+    return True, states, cost
+
+PLANNERS = {
+    "bfs-06": ("06", run_bfs, False),
+    "dijkstra-07": ("07", run_dijkstra, False),
+    "astar-08": ("08", run_astar, True),
+    "astar-09c": ("09c", run_astar, True),
+}
+
+###########################################
+# 3. MEASUREMENT
+###########################################
+
+def measure(run, leader, starts, goals, max_states, repeats):
+    """Run one case: best wall time over repeats, then one extra run for peak memory"""
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        solved, states, cost = run(leader, starts, goals, max_states)
+        times.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    run(leader, starts, goals, max_states)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "solved": solved,
+        "wall_ms": round(min(times), 3),  # Best run; the median is too noisy for sub-ms cases
+        "states": states,
+        "peak_kb": round(peak / 1024, 1),
+        "cost": cost
+    }
+
+def run_suite(quick=False, repeats=5, max_states=100, planners=None):
+    layouts = [("six-city", shipped_layout("08")), ("nine-city", shipped_layout("09c"))]
+    for num_cities in (QUICK_CITY_COUNTS if quick else GENERATED_CITY_COUNTS):
+        layouts.append(("gen-{0}".format(num_cities), generate_layout(num_cities, seed=num_cities)))
+    train_counts = QUICK_TRAIN_COUNTS if quick else TRAIN_COUNTS
+
+    results = {}
+    for planner_name, (scenario, run, multi_train) in PLANNERS.items():
+        if planners and planner_name not in planners:
+            continue
+        leader = load_leader(scenario)
+        for layout_name, (city_connectivity, track) in layouts:
+            use_layout(leader, city_connectivity, dict(track))
+            for num_trains in (train_counts if multi_train else [1]):
+                if num_trains > len(city_connectivity) // 2:
+                    continue
+                starts, goals = pick_missions(city_connectivity, num_trains, seed=num_trains)
+                key = "{0}/{1}/{2}".format(planner_name, layout_name, num_trains)
+                result = measure(run, leader, starts, goals, max_states, repeats)
+                result["cities"] = len(city_connectivity)
+                result["trains"] = num_trains
+                results[key] = result
+                print_result(key, result)
+    return results
+
+###########################################
+# 4. REPORTING AND BASELINE
+###########################################
+
+def print_header():
+    print("{0:<30} {1:>7} {2:>10} {3:>7} {4:>9} {5:>7}".format(
+        "case", "solved", "wall ms", "states", "peak KB", "cost"))
+
+def print_result(key, result):
+    print("{0:<30} {1:>7} {2:>10.2f} {3:>7} {4:>9.1f} {5:>7}".format(
+        key, "yes" if result["solved"] else "no", result["wall_ms"],
+        result["states"], result["peak_kb"],
+        result["cost"] if result["cost"] is not None else "-"))
+
+def compare_with_baseline(results, baseline, tolerance=TIME_TOLERANCE):
+    """Return a list of human-readable differences that count as regressions"""
+    problems = []
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"new case (no baseline): {key}")
+            continue
+        before = baseline[key]
+        if before["solved"] and not result["solved"]:
+            problems.append(f"{key}: no longer solved")
+        if result["states"] != before["states"]:
+            problems.append(f"{key}: states explored {before['states']} -> {result['states']}")
+        if result["cost"] != before["cost"]:
+            problems.append(f"{key}: plan cost {before['cost']} -> {result['cost']}")
+        limit = before["wall_ms"] * (1 + tolerance) + TIME_SLACK_MS
+        if result["wall_ms"] > limit:
+            problems.append(f"{key}: wall time {before['wall_ms']:.2f} ms -> {result['wall_ms']:.2f} ms")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the path planners from the leader scripts")
+    parser.add_argument("--quick", action="store_true", help="smaller grid of layouts and train counts")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per case (best wall time is kept)")
+    parser.add_argument("--max-states", type=int, default=100,
+                        help="A* search limit (the planner's max_depth)")
+    parser.add_argument("--planner", action="append", choices=sorted(PLANNERS),
+                        help="only run this planner (can be repeated)")
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE,
+                        help="allowed slowdown against the baseline as a fraction (default 0.5)")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE, help="baseline file to compare against")
+    args = parser.parse_args()
+
+    print_header()
+    results = run_suite(quick=args.quick, repeats=args.repeats,
+                        max_states=args.max_states, planners=args.planner)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print("\nNo baseline to compare against (run with --save-baseline first)")
+        return 0
+
+    problems = compare_with_baseline(results, json.loads(args.baseline.read_text()), args.tolerance)
+    if problems:
+        print("\nRegressions against baseline:")
+        for problem in problems:
+            print(f"- {problem}")
+        return 1
+    print("\nNo regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# Loads the planning code from a leader hub script so it can run on a computer.
+#
+# The leader scripts are written for Pybricks and start talking to hubs as soon
+# as they run. This module only executes their definitions (imports, constants,
+# the track layout, classes and functions) and skips everything that touches
+# hardware, prints at startup or waits for operator input.
+#
+# Needs the pybricks package from PyPI for the API definitions (Color etc.):
+#   pip install pybricks
+
+import ast
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Leader scripts with a planner, by scenario number
+LEADERS = {
+    "06": "scenario 06 - 1 self-driving train/leader_hub_06.py",
+    "07": "scenario 07 - dijkstras/leader_hub_07.py",
+    "08": "scenario 08 - multiagent trains with a-star/leader_hub_08.py",
+    "09a": "scenario 09a - five trains/leader_hub_09a.py",
+    "09b": "scenario 09b - six trains/leader_hub_09b.py",
+    "09c": "scenario 09c - nine cities/leader_hub_09c.py",
+}
+
+# MicroPython-only modules. Imports of these are skipped; the names the
+# leaders use from them are provided below where a computer needs them.
+MICROPYTHON_MODULES = {"micropython", "usys", "uselect", "ustruct"}
+
+
+class DesktopStopWatch:
+    """pybricks.tools.StopWatch backed by the computer's clock (the PyPI stub has no clock)"""
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._paused_at = None
+
+    def time(self):
+        now = self._paused_at if self._paused_at is not None else time.perf_counter()
+        return int((now - self._start) * 1000)
+
+    def pause(self):
+        if self._paused_at is None:
+            self._paused_at = time.perf_counter()
+
+    def resume(self):
+        if self._paused_at is not None:
+            self._start += time.perf_counter() - self._paused_at
+            self._paused_at = None
+
+    def reset(self):
+        self._start = time.perf_counter()
+        if self._paused_at is not None:
+            self._paused_at = self._start
+
+
+def desktop_wait(ms):
+    time.sleep(ms / 1000)
+
+
+def quiet_print(*args, **kwargs):
+    pass
+
+
+def _is_import(node):
+    if isinstance(node, ast.Import):
+        return True
+    if isinstance(node, ast.ImportFrom):
+        return True
+    return False
+
+
+def _skips_import(node):
+    if isinstance(node, ast.ImportFrom):
+        return node.module in MICROPYTHON_MODULES
+    return all(alias.name in MICROPYTHON_MODULES for alias in node.names)
+
+
+def _micropython_names(tree):
+    """Names imported from MicroPython-only modules, except const (provided below)"""
+    names = set()
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and node.module in MICROPYTHON_MODULES:
+            names.update(alias.asname or alias.name for alias in node.names)
+    names.discard("const")
+    return names
+
+
+def _calls_hardware(node, micropython_names):
+    """
+    True if the statement constructs a hub (e.g. hub = InventorHub(...)) or
+    calls into a MicroPython-only module (e.g. keyboard = poll())
+    """
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and isinstance(child.func, ast.Name):
+            if child.func.id.endswith("Hub") or child.func.id in micropython_names:
+                return True
+    return False
+
+
+def _is_definition(node, micropython_names):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(node, (ast.Assign, ast.AnnAssign)):
+        return not _calls_hardware(node, micropython_names)
+    return False
+
+
+def load_leader(scenario, verbose=False):
+    """
+    Execute the definitions of a leader script and return its namespace.
+    Prints from the leader code are silenced unless verbose is set.
+    """
+    path = REPO_ROOT / LEADERS[scenario]
+    tree = ast.parse(path.read_text(), filename=str(path))
+
+    imports = [node for node in tree.body
+               if _is_import(node) and not _skips_import(node)]
+    micropython_names = _micropython_names(tree)
+    definitions = [node for node in tree.body
+                   if _is_definition(node, micropython_names)]
+
+    namespace = {
+        "__name__": "leader_hub_" + scenario,
+        "const": lambda value: value,
+    }
+    if not verbose:
+        namespace["print"] = quiet_print
+
+    exec(compile(ast.Module(body=imports, type_ignores=[]), str(path), "exec"), namespace)
+    namespace["StopWatch"] = DesktopStopWatch
+    namespace["wait"] = desktop_wait
+    exec(compile(ast.Module(body=definitions, type_ignores=[]), str(path), "exec"), namespace)
+    return namespace
+
+
+def use_layout(leader, city_connectivity, track):
+    """Point a loaded leader at another layout and refresh derived data"""
+    leader["city_connectivity"] = city_connectivity
+    leader["track"] = track
+    if "compute_all_distances" in leader:
+        leader["all_distances"] = leader["compute_all_distances"]()
+    if "build_pattern_index" in leader:
+        leader["pattern_index"] = leader["build_pattern_index"]()
+    if "analyze_patterns" in leader:
+        leader["pattern_problems"], leader["stop_patterns"] = leader["analyze_patterns"]()